@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import time
+
+import aiohttp
+
+from async_elasticpath import (AsyncCache,
+                               add_product_to_cart,
+                               delete_product_from_cart,
+                               get_cart_items,
+                               get_currencies,
+                               remove_all_from_cart)
+from cart import CartOperations, LocalCart
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCartStore:
+    def __init__(self, elastic_client, flush_delay=0.5, maxsize=10000, ttl=300, currency_ttl=3600):
+        self.elastic_client = elastic_client
+        self.flush_delay = flush_delay
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.currencies = AsyncCache(lambda _: get_currencies(elastic_client),
+                                     maxsize=1,
+                                     ttl=currency_ttl,
+                                     name='currencies')
+        self._carts = OrderedDict()
+        self._dirty = set()
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._stopped.set()
+        await self._task
+        await self._flush_dirty()
+
+    async def get_items(self, user_id):
+        cart = await self._load(user_id)
+        currencies = await self._get_currencies()
+        return self._carts.setdefault(user_id, cart).render(currencies)
+
+    async def add(self, user_id, product_id, product_info, quantity):
+        cart = await self._load(user_id)
+        self._carts.setdefault(user_id, cart).add(product_id, product_info, quantity)
+        self._dirty.add(user_id)
+
+    async def remove(self, user_id, product_id):
+        cart = await self._load(user_id)
+        self._carts.setdefault(user_id, cart).remove(product_id)
+        self._dirty.add(user_id)
+
+    async def remove_all(self, user_id):
+        cart = await self._load(user_id)
+        self._carts.setdefault(user_id, cart).remove_all()
+        self._dirty.add(user_id)
+
+    async def _load(self, user_id):
+        cart = self._carts.get(user_id)
+        if cart is not None:
+            self._carts.move_to_end(user_id)
+            if time() - cart.loaded_at < self.ttl or not cart.is_idle():
+                return cart
+            version = cart.version
+        try:
+            items, _ = await get_cart_items(self.elastic_client, user_id)
+        except Exception:
+            if cart is None:
+                raise
+            logger.exception('Cart %s reload failed, using the cached copy', user_id)
+            return cart
+        if cart is None:
+            cart = self._carts.setdefault(user_id, LocalCart(items))
+            self._evict()
+        elif cart.version == version and cart.is_idle():
+            cart.replace(items)
+        return cart
+
+    async def _get_currencies(self):
+        try:
+            return await self.currencies.get('currencies')
+        except Exception:
+            logger.exception('Could not load the currency formats')
+            return {}
+
+    def _evict(self):
+        for user_id in list(self._carts):
+            if len(self._carts) <= self.maxsize:
+                return
+            if self._carts[user_id].is_idle():
+                del self._carts[user_id]
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.flush_delay)
+            except asyncio.TimeoutError:
+                await self._flush_dirty()
+
+    async def _flush_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        await asyncio.gather(*(self._flush(user_id) for user_id in dirty))
+
+    async def _flush(self, user_id):
+        cart = self._carts[user_id]
+        operations, cart.pending = cart.pending, CartOperations()
+        cart.flushing = True
+        item_ids = {product_id: item['item_id'] for product_id, item in cart.items.items()}
+        try:
+            await self._apply(user_id, operations, item_ids)
+        except aiohttp.ClientResponseError:
+            logger.exception('Cart %s flush was rejected, reloading it from Elastic Path', user_id)
+        except Exception:
+            logger.exception('Cart %s flush failed, will retry', user_id)
+            cart.pending = operations.merge(cart.pending)
+            cart.flushing = False
+            self._dirty.add(user_id)
+            return
+        await self._reconcile(user_id, cart)
+
+    async def _apply(self, user_id, operations, item_ids):
+        if operations.clear:
+            await remove_all_from_cart(self.elastic_client, user_id)
+            operations.clear = False
+        if operations.removes:
+            upstream_items, _ = await get_cart_items(self.elastic_client, user_id)
+            item_ids.update({item['product_id']: item['id'] for item in upstream_items})
+        while operations.removes:
+            product_id = next(iter(operations.removes))
+            if item_ids.get(product_id):
+                await delete_product_from_cart(self.elastic_client, user_id, item_ids[product_id])
+            operations.removes.discard(product_id)
+        while operations.adds:
+            product_id, quantity = next(iter(operations.adds.items()))
+            await add_product_to_cart(self.elastic_client, user_id, product_id, quantity)
+            del operations.adds[product_id]
+
+    async def _reconcile(self, user_id, cart):
+        version = cart.version
+        try:
+            items, _ = await get_cart_items(self.elastic_client, user_id)
+        except Exception:
+            logger.exception('Cart %s reconciliation failed', user_id)
+            items = None
+        cart.flushing = False
+        if items is not None and cart.version == version and not cart.pending:
+            cart.replace(items)
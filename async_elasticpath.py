@@ -0,0 +1,364 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from time import time
+
+import aiohttp
+
+from elasticpath import (CatalogIndex,
+                         parse_cart_items,
+                         parse_currencies,
+                         parse_product_file,
+                         parse_product_cards,
+                         parse_product_info,
+                         parse_product_record)
+from ratelimit import RateLimiter
+from metrics import CACHE_REQUESTS, ELASTICPATH_RESPONSES, TOKEN_REFRESHES, track_call
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class AsyncElasticPathClient:
+    def __init__(self, store_id, client_id, client_secret,
+                 base_url='https://useast.api.elasticpath.com',
+                 pool_size=100,
+                 timeout=10,
+                 retries=3,
+                 backoff_factor=0.3,
+                 rate_limit=25,
+                 burst=25):
+        self.store_id = store_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limiter = RateLimiter(rate_limit, burst, name='elasticpath')
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size),
+                                             timeout=aiohttp.ClientTimeout(total=timeout),
+                                             headers={'accept': 'application/json',
+                                                      'content-type': 'application/json',
+                                                      'x-moltin-auth-store': str(store_id)})
+        self.tokens = AsyncTokenManager(lambda: update_elastic_token(self))
+
+    async def request(self, method, path, auth=True, **kwargs):
+        headers = kwargs.pop('headers', {})
+        url = f'{self.base_url}{path}'
+        if not auth:
+            return await self._send(method, url, headers, **kwargs)
+        token = await self.tokens.get()
+        headers['Authorization'] = f'Bearer {token}'
+        response = await self._send(method, url, headers, **kwargs)
+        if response.status == 401:
+            self.tokens.invalidate(token)
+            headers['Authorization'] = f'Bearer {await self.tokens.get()}'
+            response = await self._send(method, url, headers, **kwargs)
+        return response
+
+    async def _send(self, method, url, headers, **kwargs):
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self.limiter.acquire())
+            async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                await response.read()
+            ELASTICPATH_RESPONSES.inc(method=method, status=response.status)
+            can_retry = (method in IDEMPOTENT_METHODS or response.status == 429) and attempt < self.retries
+            if response.status not in RETRY_STATUSES or not can_retry:
+                return response
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            else:
+                delay = self.backoff_factor * (2 ** attempt)
+            if response.status == 429:
+                self.limiter.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        self.tokens.close()
+        await self.session.close()
+
+
+class AsyncTokenManager:
+    def __init__(self, fetch, refresh_margin=60, expiry_margin=5, retry_delay=5):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.expiry_margin = expiry_margin
+        self.retry_delay = retry_delay
+        self._token = None
+        self._expires_at = 0
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if self._token is not None and time() < self._expires_at - self.expiry_margin:
+            return self._token
+        async with self._lock:
+            if self._token is None or time() >= self._expires_at - self.expiry_margin:
+                await self._refresh()
+            return self._token
+
+    def invalidate(self, token):
+        if self._token == token:
+            self._token = None
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _refresh(self):
+        try:
+            self._token, self._expires_at = await self.fetch()
+        except Exception:
+            TOKEN_REFRESHES.inc(result='error')
+            raise
+        TOKEN_REFRESHES.inc(result='ok')
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._background_refresh())
+
+    async def _background_refresh(self):
+        delay = self._expires_at - self.refresh_margin - time()
+        while True:
+            await asyncio.sleep(max(delay, 0))
+            async with self._lock:
+                if time() < self._expires_at - self.refresh_margin:
+                    delay = self._expires_at - self.refresh_margin - time()
+                    continue
+                try:
+                    self._token, self._expires_at = await self.fetch()
+                    TOKEN_REFRESHES.inc(result='ok')
+                    delay = self._expires_at - self.refresh_margin - time()
+                except Exception:
+                    TOKEN_REFRESHES.inc(result='error')
+                    logger.exception('Elastic Path token refresh failed')
+                    delay = self.retry_delay
+
+
+class AsyncCache:
+    def __init__(self, loader, maxsize=256, ttl=600, name='cache'):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.capacity = maxsize
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if entry[0] <= time() and key not in self._pending:
+                self._pending[key] = asyncio.ensure_future(self._load(key))
+                self._pending[key].add_done_callback(self._log_failure)
+            CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            return entry[1]
+        CACHE_REQUESTS.inc(cache=self.name, result='miss')
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(self._load(key))
+        return await asyncio.shield(self._pending[key])
+
+    def warm(self, key):
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(self._load(key))
+            self._pending[key].add_done_callback(self._log_failure)
+
+    def set(self, key, value):
+        self._entries[key] = (time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def set_many(self, items):
+        self.capacity = len(items) + self.maxsize
+        expires_at = time() + self.ttl
+        for key, value in items.items():
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def _load(self, key):
+        try:
+            value = await self.loader(key)
+            self.set(key, value)
+            return value
+        finally:
+            self._pending.pop(key, None)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Background cache refresh failed', exc_info=future.exception())
+
+
+@track_call
+async def get_all_products(client):
+    response = await client.request("GET", '/pcm/products')
+    response.raise_for_status()
+    return (await response.json())['data']
+
+
+@track_call
+async def get_catalog_page(client, offset, limit):
+    params = {'page[offset]': offset, 'page[limit]': limit}
+    response = await client.request("GET", '/catalog/products', params=params)
+    response.raise_for_status()
+    return await response.json()
+
+
+@track_call
+async def get_pcm_page(client, offset, limit):
+    params = {'page[offset]': offset, 'page[limit]': limit, 'include': 'files'}
+    response = await client.request("GET", '/pcm/products', params=params)
+    response.raise_for_status()
+    return await response.json()
+
+
+async def get_pages(client, get_page, page_size=100):
+    first_page = await get_page(client, 0, page_size)
+    total = first_page['meta']['results']['total']
+    pages = await asyncio.gather(*(get_page(client, offset, page_size)
+                                   for offset in range(page_size, total, page_size)))
+    return [first_page, *pages]
+
+
+async def load_catalog(client, page_size=100):
+    catalog_pages, pcm_pages = await asyncio.gather(get_pages(client, get_catalog_page, page_size),
+                                                    get_pages(client, get_pcm_page, page_size))
+    catalog_products = [product for page in catalog_pages for product in page['data']]
+    product_cards = parse_product_cards(catalog_products, pcm_pages)
+    missing_links = list({card['photo_id'] for card in product_cards.values() if card['photo_link'] is None})
+    file_links = dict(zip(missing_links, await asyncio.gather(*(get_file_link(client, file_id)
+                                                                for file_id in missing_links))))
+    for product_card in product_cards.values():
+        product_card['photo_link'] = product_card['photo_link'] or file_links[product_card['photo_id']]
+    return CatalogIndex([parse_product_record(product) for product in catalog_products]), product_cards
+
+
+@track_call
+async def get_cart_items(client, cart_id):
+    response = await client.request("GET", f'/v2/carts/{cart_id}/items')
+    response.raise_for_status()
+    return parse_cart_items(await response.json())
+
+
+@track_call
+async def get_currencies(client):
+    response = await client.request("GET", '/v2/currencies')
+    response.raise_for_status()
+    return parse_currencies(await response.json())
+
+
+@track_call
+async def add_product_to_cart(client, cart_id, product_id, quantity: int):
+    payload = json.dumps({"data": {'id': product_id,
+                                   'type': "cart_item",
+                                   'quantity': quantity}})
+    response = await client.request("POST", f'/v2/carts/{cart_id}/items', data=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@track_call
+async def delete_product_from_cart(client, cart_id, product_id):
+    response = await client.request("DELETE", f'/v2/carts/{cart_id}/items/{product_id}')
+    response.raise_for_status()
+    return await response.json()
+
+
+@track_call
+async def remove_all_from_cart(client, cart_id):
+    response = await client.request("DELETE", f'/v2/carts/{cart_id}/items')
+    response.raise_for_status()
+    return response
+
+
+@track_call
+async def get_catalog_product(client, product_id):
+    response = await client.request("GET", f'/catalog/products/{product_id}')
+    response.raise_for_status()
+    return await response.json()
+
+
+@track_call
+async def get_pcm_product(client, product_id, include=None):
+    params = {'include': include} if include else None
+    response = await client.request("GET", f'/pcm/products/{product_id}', params=params)
+    response.raise_for_status()
+    return await response.json()
+
+
+@track_call
+async def get_product_info_by_id(client, product_id):
+    product_info, product_description = await asyncio.gather(get_catalog_product(client, product_id),
+                                                             get_pcm_product(client, product_id))
+    return parse_product_info(product_info, product_description)
+
+
+@track_call
+async def get_product_card(client, product_id):
+    product_info, product_description = await asyncio.gather(get_catalog_product(client, product_id),
+                                                             get_pcm_product(client, product_id, include='files'))
+    product_card = parse_product_info(product_info, product_description)
+    product_card['photo_id'], product_card['photo_link'] = parse_product_file(product_description)
+    if product_card['photo_link'] is None:
+        product_card['photo_link'] = await get_file_link(client, product_card['photo_id'])
+    return product_card
+
+
+@track_call
+async def get_product_file_id(client, product_id):
+    response = await client.request("GET", f'/pcm/products/{product_id}/relationships/files')
+    response.raise_for_status()
+    return (await response.json())['data'][0]['id']
+
+
+@track_call
+async def get_file_link(client, file_id):
+    response = await client.request("GET", f'/v2/files/{file_id}')
+    response.raise_for_status()
+    return (await response.json())['data']['link']['href']
+
+
+@track_call
+async def get_photo_by_productid(client, product_id):
+    file_id = await get_product_file_id(client, product_id)
+    return await get_file_link(client, file_id)
+
+
+@track_call
+async def create_customer(client, name, email, password):
+    payload = json.dumps({"data": {
+        "type": "customer",
+        "name": str(name),
+        "email": str(email),
+        "password": str(password)}})
+    response = await client.request("POST", '/v2/customers', data=payload)
+    return response.status
+
+
+@track_call
+async def update_elastic_token(client):
+    payload = {'client_id': client.client_id,
+               'client_secret': client.client_secret,
+               'grant_type': 'client_credentials'}
+    headers = {'content-type': 'application/x-www-form-urlencoded'}
+    response = await client.request("POST", '/oauth/access_token', auth=False, headers=headers, data=payload)
+    response.raise_for_status()
+    response_credentials = await response.json()
+    token = response_credentials['access_token']
+    token_lifetime = response_credentials['expires']
+    return token, float(token_lifetime)
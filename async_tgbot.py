@@ -0,0 +1,616 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import partial
+
+import aiohttp
+from dotenv import load_dotenv
+
+from async_elasticpath import (AsyncElasticPathClient,
+                               AsyncCache,
+                               get_product_card,
+                               load_catalog,
+                               create_customer)
+from async_cart import AsyncCartStore
+from checkout import (CREATED,
+                      EXISTS,
+                      FAILED,
+                      FOLLOW_UPS,
+                      CustomerJob,
+                      collapse_jobs,
+                      get_customer_result,
+                      is_valid_email)
+from conversation import State
+from dedup import UpdateDeduplicator
+from metrics import CACHE_REQUESTS, start_instrumentation, track_handler
+from persistence import PersistentDict, create_backend
+from photo_cache import PhotoCache
+from ratelimit import create_telegram_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramError(Exception):
+    pass
+
+
+def run_blocking(function, *args):
+    return asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+class AsyncBot:
+    def __init__(self, token, session, limiter, retries=3, idle_delay=0.05):
+        self.url = f'https://api.telegram.org/bot{token}/'
+        self.session = session
+        self.limiter = limiter
+        self.retries = retries
+        self.idle_delay = idle_delay
+        self._deletes = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def request(self, method, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        async with self.session.post(f'{self.url}{method}', json=params) as response:
+            return await response.json()
+
+    async def acquire(self, key=None, low_priority=False):
+        while True:
+            wait = self.limiter.ready_at(key) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            delay = self.limiter.acquire(key, low_priority)
+            if delay is not None:
+                return delay
+            await asyncio.sleep(self.idle_delay)
+
+    async def call(self, method, key=None, low_priority=False, **params):
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(await self.acquire(key, low_priority))
+            result = await self.request(method, **params)
+            if result['ok']:
+                return result['result']
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if retry_after is None or attempt == self.retries:
+                raise TelegramError(result.get('description'))
+            logger.warning('Telegram flood control, retrying in %s seconds', retry_after)
+            self.limiter.pause(retry_after, key)
+
+    async def get_updates(self, offset=None, timeout=30):
+        result = await self.request('getUpdates', offset=offset, timeout=timeout,
+                                    allowed_updates=['message', 'callback_query'])
+        if not result['ok']:
+            raise TelegramError(result.get('description'))
+        return result['result']
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', key=chat_id, chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None):
+        return await self.call('sendPhoto', key=chat_id, chat_id=chat_id, photo=photo, caption=caption,
+                               reply_markup=reply_markup)
+
+    async def delete_message(self, chat_id, message_id):
+        self._deletes[(chat_id, message_id)] = None
+        self._wakeup.set()
+        return True
+
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=False):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id,
+                               text=text, show_alert=show_alert)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            while self._deletes:
+                chat_id, message_id = next(iter(self._deletes))
+                try:
+                    await self.call('deleteMessage', low_priority=True, chat_id=chat_id, message_id=message_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError) as error:
+                    logger.debug('Could not delete message %s in chat %s: %s', message_id, chat_id, error)
+                self._deletes.pop((chat_id, message_id), None)
+            self._wakeup.clear()
+
+
+class Update:
+    def __init__(self, raw):
+        self.update_id = raw['update_id']
+        self.callback_query = raw.get('callback_query')
+        if self.callback_query:
+            self.effective_message = self.callback_query['message']
+            self.effective_user = self.callback_query['from']
+            self.data = self.callback_query.get('data', '')
+        else:
+            self.effective_message = raw.get('message') or {}
+            self.effective_user = self.effective_message.get('from', {})
+            self.data = self.effective_message.get('text', '')
+        self.chat_id = self.effective_message.get('chat', {}).get('id')
+
+    async def delete_message(self, bot):
+        await bot.delete_message(self.chat_id, self.effective_message['message_id'])
+
+
+def button(text, callback_data):
+    return {'text': text, 'callback_data': callback_data}
+
+
+def inline_keyboard(keyboard):
+    return {'inline_keyboard': keyboard}
+
+
+class AsyncCheckoutPipeline:
+    def __init__(self, elastic_client, notify, customers=None, batch_size=20, batch_delay=0.2,
+                 retries=3, retry_delay=1.0):
+        self.elastic_client = elastic_client
+        self.notify = notify
+        self.customers = {} if customers is None else customers
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue()
+        self._retrying = {}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._queue.put_nowait(None)
+        await self._task
+        retrying, self._retrying = self._retrying, {}
+        for job, handle in retrying.values():
+            handle.cancel()
+            job.attempt = self.retries
+        if retrying:
+            await self._process_batch([job for job, _ in retrying.values()])
+
+    def submit(self, chat_id, name, email, password):
+        self._queue.put_nowait(CustomerJob(email.strip().lower(), name, password, chat_id))
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self._queue.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    job = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if job is None:
+                    await self._process_batch(batch)
+                    return
+                batch.append(job)
+            await self._process_batch(batch)
+
+    async def _process_batch(self, batch):
+        try:
+            await self._process(batch)
+        except Exception:
+            logger.exception('Checkout batch of %s customers failed', len(batch))
+
+    async def _process(self, batch):
+        jobs, known = await run_blocking(collapse_jobs, batch, self._find_retrying, self.customers)
+        for job in known:
+            await self._notify(job, EXISTS)
+        statuses = await asyncio.gather(*(create_customer(self.elastic_client, job.name, job.email, job.password)
+                                          for job in jobs),
+                                        return_exceptions=True)
+        for job, status in zip(jobs, statuses):
+            if isinstance(status, Exception):
+                logger.error('Could not create customer %s', job.email, exc_info=status)
+                result = None
+            else:
+                result = get_customer_result(status)
+            if result is None:
+                await self._retry(job)
+            else:
+                await self._finish(job, result)
+
+    def _find_retrying(self, email):
+        retrying = self._retrying.get(email)
+        return retrying[0] if retrying is not None else None
+
+    async def _retry(self, job):
+        if job.attempt >= self.retries:
+            await self._finish(job, FAILED)
+            return
+        job.attempt += 1
+        handle = asyncio.get_event_loop().call_later(self.retry_delay * 2 ** (job.attempt - 1),
+                                                     self._queue.put_nowait, job)
+        self._retrying[job.email] = (job, handle)
+
+    async def _finish(self, job, result):
+        self._retrying.pop(job.email, None)
+        if result in (CREATED, EXISTS):
+            self.customers[job.email] = result
+        await self._notify(job, result)
+
+    async def _notify(self, job, result):
+        for chat_id in job.chat_ids:
+            try:
+                await self.notify(chat_id, FOLLOW_UPS[result].format(email=job.email))
+            except Exception:
+                logger.exception('Could not send the checkout result to chat %s', chat_id)
+
+
+class AsyncConversation:
+    def __init__(self, entry_points, states, fallbacks, max_concurrency=1000):
+        self.entry_points = entry_points
+        self.states = states
+        self.fallbacks = fallbacks
+        self.chat_states = {}
+        self._chat_locks = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @staticmethod
+    def matches(route, update):
+        kind, pattern, _ = route
+        if kind == 'command':
+            return not update.callback_query and re.match(rf'/{pattern}(@\w+)?(\s|$)', update.data)
+        if kind == 'text':
+            return not update.callback_query and update.data and not update.data.startswith('/')
+        return update.callback_query and (pattern is None or re.match(pattern, update.data))
+
+    def find_handler(self, update):
+        state = self.chat_states.get(update.chat_id)
+        routes = self.entry_points if state is None else self.states.get(state, []) + self.fallbacks
+        for route in routes:
+            if self.matches(route, update):
+                return route[2]
+
+    async def process(self, bot, update):
+        chat_lock = self._chat_locks.setdefault(update.chat_id, [asyncio.Lock(), 0])
+        chat_lock[1] += 1
+        try:
+            async with chat_lock[0], self._semaphore:
+                handler = self.find_handler(update)
+                if handler is None:
+                    return
+                new_state = await handler(bot, update)
+                if new_state is not None:
+                    self.chat_states[update.chat_id] = new_state
+        finally:
+            chat_lock[1] -= 1
+            if not chat_lock[1]:
+                del self._chat_locks[update.chat_id]
+
+
+def build_products_keyboard(records):
+    return [[button(record.name, record.id)] for record in records]
+
+
+@track_handler
+async def handle_menu(bot, update, menu_cache, page_size):
+    catalog = await menu_cache.get('menu')
+    pages = catalog.pages(page_size)
+    page = 0
+    if update.callback_query and update.data.startswith('menu_page'):
+        page = min(max(int(update.data.split(' ')[1]), 0), pages - 1)
+    keyboard = build_products_keyboard(catalog.page(page, page_size))
+    navigation = []
+    if page > 0:
+        navigation.append(button('< Prev', f'menu_page {page - 1}'))
+    if page < pages - 1:
+        navigation.append(button('Next >', f'menu_page {page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    await asyncio.gather(update.delete_message(bot),
+                         bot.send_message(update.chat_id,
+                                          f"Let's choose (page {page + 1}/{pages}). "
+                                          f"Send a name or SKU to search:",
+                                          reply_markup=inline_keyboard(keyboard)))
+    return State.HANDLE_DESCRIPTION
+
+
+@track_handler
+async def handle_search(bot, update, menu_cache, page_size):
+    records = (await menu_cache.get('menu')).search(update.data, page_size)
+    keyboard = build_products_keyboard(records)
+    keyboard.append([button('Menu', 'menu_page 0')])
+    text = 'Found:' if records else 'Nothing found. Try another name or SKU'
+    await bot.send_message(update.chat_id, text, reply_markup=inline_keyboard(keyboard))
+    return State.HANDLE_DESCRIPTION
+
+
+async def prefetch_catalog(elastic_client, product_cache, photo_cache, page_size=100):
+    catalog, product_cards = await load_catalog(elastic_client, page_size)
+    await run_blocking(photo_cache.discard_stale, {product_id: product_card['photo_id']
+                                                   for product_id, product_card in product_cards.items()})
+    product_cache.set_many(product_cards)
+    return catalog
+
+
+async def refresh_periodically(cache, key, interval):
+    while True:
+        await asyncio.sleep(interval)
+        cache.warm(key)
+
+
+async def load_product_card(product_id, elastic_client, photo_cache):
+    product_card = await get_product_card(elastic_client, product_id)
+    await run_blocking(photo_cache.discard_stale, {product_id: product_card['photo_id']})
+    return product_card
+
+
+@track_handler
+async def handle_description(bot, update, product_cache, photo_cache):
+    product_id = update.data
+    product_info = await product_cache.get(product_id)
+    cached_photo = await run_blocking(photo_cache.get, product_id)
+    if cached_photo and cached_photo[0] == product_info['photo_id']:
+        CACHE_REQUESTS.inc(cache='photo', result='hit')
+        photo = cached_photo[1]
+    else:
+        CACHE_REQUESTS.inc(cache='photo', result='miss')
+        photo = product_info['photo_link']
+    product_name = product_info['product_name']
+    product_description = product_info['product_description']
+    product_price = product_info['product_price']
+    product_sku = product_info['product_sku']
+    keyboard = [[button('Buy 1kg', f'add_to_cart {product_id} 1'),
+                 button('Buy 3kg', f'add_to_cart {product_id} 3'),
+                 button('Buy 10kg', f'add_to_cart {product_id} 10')],
+                [button('Go to cart', 'cart_info')],
+                [button('Back', 'back')]]
+    send_photo = partial(bot.send_photo,
+                         update.chat_id,
+                         caption=f'{product_name}\n'
+                                 f'{product_description}\n'
+                                 f'{product_price}\n'
+                                 f'{product_sku}',
+                         reply_markup=inline_keyboard(keyboard))
+    await asyncio.gather(send_product_photo(send_photo, photo_cache, product_id, product_info, photo),
+                         update.delete_message(bot))
+    return State.HANDLE_DESCRIPTION
+
+
+async def send_product_photo(send_photo, photo_cache, product_id, product_info, photo):
+    if photo != product_info['photo_link']:
+        try:
+            return await send_photo(photo=photo)
+        except TelegramError:
+            logger.warning('Cached photo of product %s was rejected, sending it from Elastic Path', product_id)
+            await run_blocking(photo_cache.delete, product_id)
+    message = await send_photo(photo=product_info['photo_link'])
+    await run_blocking(photo_cache.set, product_id, product_info['photo_id'], message['photo'][-1]['file_id'])
+    return message
+
+
+@track_handler
+async def add_to_cart(bot, update, cart_store, product_cache):
+    cart_id = update.effective_user['id']
+    product_id = update.data.split(' ')[1]
+    quantity = int(update.data.split(' ')[2])
+    await cart_store.add(cart_id, product_id, await product_cache.get(product_id), quantity)
+    await bot.answer_callback_query(update.callback_query['id'], text='The product has been added to cart')
+    return State.HANDLE_DESCRIPTION
+
+
+@track_handler
+async def handle_cart_info(bot, update, cart_store):
+    cart_id = update.effective_user['id']
+    if update.callback_query:
+        try:
+            product = update.data.split(' ')[1]
+            await cart_store.remove(cart_id, product)
+        except IndexError:
+            pass
+    cart_info, total_price = await cart_store.get_items(cart_id)
+    products_in_cart_info = []
+    keyboard = [[button('Menu', 'menu'),
+                 button('Remove all', 'remove_all')],
+                [button('Checkout', 'checkout')]]
+    single_remove_keyboard = []
+    for product in cart_info:
+        id = product['id']
+        name = product['name']
+        qty = product['qty']
+        price = product['price']
+        product_subtotal = product['subtotal']
+        message = f'Name: {name}\n Qty: {qty}\n Price: {price}\n Subtotal: {product_subtotal}\n\n'
+        products_in_cart_info.append(message)
+        single_remove_keyboard.append(button(f'Delete {name}', f'remove_item {id}'))
+    keyboard.insert(0, single_remove_keyboard)
+    await asyncio.gather(bot.send_message(cart_id,
+                                          f'{" ".join(products_in_cart_info)}\n Total: {total_price}',
+                                          reply_markup=inline_keyboard(keyboard)),
+                         update.delete_message(bot))
+    return State.HANDLE_CART
+
+
+@track_handler
+async def handle_remove_all_from_cart(bot, update, cart_store):
+    cart_id = update.effective_user['id']
+    await cart_store.remove_all(cart_id)
+    keyboard = [[button('Menu', 'menu')]]
+    await asyncio.gather(bot.answer_callback_query(update.callback_query['id'],
+                                                   text='The product has been added to cart'),
+                         bot.send_message(update.chat_id,
+                                          'Now your cart is empty. Please go to the "Menu"',
+                                          reply_markup=inline_keyboard(keyboard)),
+                         update.delete_message(bot))
+    return State.HANDLE_CART
+
+
+@track_handler
+async def checkout(bot, update):
+    user_first_name = update.effective_user.get('first_name')
+    keyboard = [[button("Back to cart", "cart_info")]]
+    await asyncio.gather(bot.send_message(update.effective_user['id'],
+                                          f'Dear {user_first_name}, '
+                                          f'please share your email.',
+                                          reply_markup=inline_keyboard(keyboard)),
+                         update.delete_message(bot))
+    return State.WAITING_EMAIL
+
+
+@track_handler
+async def get_email(bot, update, checkout_pipeline):
+    user_name = update.effective_user.get('first_name')
+    user_email = update.data.strip()
+    user_password = update.effective_user['id']
+    if not is_valid_email(user_email):
+        await bot.send_message(update.chat_id, 'Your email is not valid. Try again')
+        return State.WAITING_EMAIL
+    checkout_pipeline.submit(update.chat_id, user_name, user_email, user_password)
+    keyboard = [[button("Back to menu", "menu")]]
+    await bot.send_message(update.chat_id, f'Your email {user_email}. We contact you shortly',
+                           reply_markup=inline_keyboard(keyboard))
+    return State.WAITING_EMAIL
+
+
+def build_conversation(cart_store, menu_cache, product_cache, photo_cache, checkout_pipeline, page_size=10):
+    menu = partial(handle_menu, menu_cache=menu_cache, page_size=page_size)
+    search = partial(handle_search, menu_cache=menu_cache, page_size=page_size)
+    description = partial(handle_description, product_cache=product_cache, photo_cache=photo_cache)
+    cart = partial(add_to_cart, cart_store=cart_store, product_cache=product_cache)
+    cart_info = partial(handle_cart_info, cart_store=cart_store)
+    remove_all = partial(handle_remove_all_from_cart, cart_store=cart_store)
+    email = partial(get_email, checkout_pipeline=checkout_pipeline)
+    return AsyncConversation(
+        entry_points=[('command', 'start', menu)],
+        states={State.HANDLE_MENU: [('callback', 'remove_all', menu),
+                                    ('callback', None, menu)],
+                State.HANDLE_DESCRIPTION: [('callback', '^add_to_cart', cart),
+                                           ('callback', 'cart_info', cart_info),
+                                           ('callback', 'back', menu),
+                                           ('callback', '^menu_page', menu),
+                                           ('text', None, search),
+                                           ('callback', None, description)],
+                State.HANDLE_CART: [('callback', 'menu', menu),
+                                    ('callback', 'remove_all', remove_all),
+                                    ('callback', '^remove_item', cart_info),
+                                    ('callback', 'checkout', checkout)],
+                State.WAITING_EMAIL: [('text', None, email),
+                                      ('callback', 'cart_info', cart_info),
+                                      ('callback', None, menu)]},
+        fallbacks=[('command', 'start', menu)])
+
+
+async def handle_update(bot, conversation, update, deduplicator):
+    try:
+        if deduplicator.is_duplicate(update.update_id, update.effective_user.get('id'),
+                                     update.data if update.callback_query else None):
+            if update.callback_query:
+                await bot.answer_callback_query(update.callback_query['id'])
+            return
+        await conversation.process(bot, update)
+    except Exception:
+        logger.exception('Update %s failed', update.update_id)
+
+
+async def poll(bot, conversation, deduplicator, max_pending=1000):
+    offset = None
+    tasks = set()
+    try:
+        while True:
+            while len(tasks) >= max_pending:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            try:
+                updates = await bot.get_updates(offset)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError):
+                logger.exception('getUpdates failed')
+                await asyncio.sleep(1)
+                continue
+            for raw_update in updates:
+                offset = raw_update['update_id'] + 1
+                task = asyncio.ensure_future(handle_update(bot, conversation, Update(raw_update), deduplicator))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run():
+    tg_token = os.getenv("TG_TOKEN")
+    client_id = os.getenv('CLIENT_ID')
+    client_secret = os.getenv('CLIENT_SECRET')
+    store_id = os.getenv('STORE_ID')
+    pool_size = int(os.getenv('ELASTIC_POOL_SIZE', 100))
+    catalog_ttl = int(os.getenv('CATALOG_TTL', 600))
+    elastic_client = AsyncElasticPathClient(store_id, client_id, client_secret, pool_size=pool_size,
+                                            rate_limit=float(os.getenv('ELASTIC_RATE_LIMIT', 25)))
+    photo_cache = PhotoCache(os.getenv('PHOTO_CACHE_PATH', 'photo_cache.sqlite3'))
+    product_cache = AsyncCache(partial(load_product_card,
+                                       elastic_client=elastic_client,
+                                       photo_cache=photo_cache),
+                               maxsize=int(os.getenv('PRODUCT_CACHE_SIZE', 256)),
+                               ttl=catalog_ttl,
+                               name='product')
+    menu_cache = AsyncCache(lambda _: prefetch_catalog(elastic_client, product_cache, photo_cache,
+                                                       page_size=int(os.getenv('CATALOG_PAGE_SIZE', 100))),
+                            maxsize=1,
+                            ttl=catalog_ttl,
+                            name='menu')
+    menu_cache.warm('menu')
+    refresher = asyncio.ensure_future(refresh_periodically(menu_cache, 'menu',
+                                                           float(os.getenv('PREFETCH_INTERVAL', catalog_ttl / 2))))
+    deduplicator = UpdateDeduplicator(callback_window=float(os.getenv('DEDUP_WINDOW', 1.0)))
+    state_backend = create_backend(os.getenv('STATE_BACKEND', 'sqlite'),
+                                   path=os.getenv('STATE_PATH', 'bot_state.sqlite3'),
+                                   redis_url=os.getenv('REDIS_URL'))
+    customers = PersistentDict(state_backend, 'customers')
+    customers.start()
+    conversations = PersistentDict(state_backend, 'conversations',
+                                   encode=lambda state: state.name,
+                                   decode=lambda name: State[name])
+    conversations.start()
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        bot = AsyncBot(tg_token, session, create_telegram_limiter())
+        bot.start()
+        checkout_pipeline = AsyncCheckoutPipeline(elastic_client,
+                                                  notify=bot.send_message,
+                                                  customers=customers,
+                                                  batch_size=int(os.getenv('CHECKOUT_BATCH_SIZE', 20)))
+        checkout_pipeline.start()
+        cart_store = AsyncCartStore(elastic_client,
+                                    flush_delay=float(os.getenv('CART_FLUSH_DELAY', 0.5)),
+                                    maxsize=int(os.getenv('CART_CACHE_SIZE', 10000)),
+                                    ttl=float(os.getenv('CART_TTL', 300)))
+        cart_store.start()
+        conversation = build_conversation(cart_store, menu_cache, product_cache, photo_cache,
+                                          checkout_pipeline,
+                                          page_size=int(os.getenv('MENU_PAGE_SIZE', 10)))
+        conversation.chat_states = conversations
+        try:
+            await poll(bot, conversation, deduplicator, max_pending=int(os.getenv('MAX_PENDING_UPDATES', 1000)))
+        finally:
+            refresher.cancel()
+            await checkout_pipeline.stop()
+            await cart_store.stop()
+            await bot.stop()
+            customers.stop()
+            conversations.stop()
+            state_backend.close()
+            await elastic_client.close()
+            photo_cache.close()
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=os.getenv('LOG_LEVEL', 'INFO'))
+    start_instrumentation(metrics_port=os.getenv('METRICS_PORT'),
+                          metrics_listen=os.getenv('METRICS_LISTEN', '127.0.0.1'),
+                          profile_interval=os.getenv('PROFILE_INTERVAL'))
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
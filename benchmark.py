@@ -0,0 +1,241 @@
+import argparse
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from cart import CartStore
+from checkout import CheckoutPipeline
+from elasticpath import ElasticPathClient, CatalogCache, ProductCache
+from mock_elasticpath import MockElasticPathServer, MockStore
+from photo_cache import PhotoCache
+from ratelimit import Outbox, RateLimiter
+from tgbot import build_conversation_handler, load_product_card, prefetch_catalog
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def timed(self, name, function):
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            error = False
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.record(name, time.perf_counter() - started_at, error)
+        return wrapper
+
+    def summary(self):
+        summary = {}
+        for name, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            summary[name] = {'count': len(samples),
+                             'errors': self.errors.get(name, 0),
+                             'p50': percentile(samples, 50) * 1000,
+                             'p95': percentile(samples, 95) * 1000,
+                             'p99': percentile(samples, 99) * 1000}
+        return summary
+
+
+def percentile(sorted_samples, percent):
+    index = max(int(round(percent / 100 * len(sorted_samples))) - 1, 0)
+    return sorted_samples[index]
+
+
+class FakeBot:
+    username = 'benchmark_bot'
+
+    def __init__(self, latency=0.0, senders=4):
+        self.latency = latency
+        self.outbox = Outbox(RateLimiter(10 ** 6, 10 ** 6), workers=senders, name='benchmark-outbox')
+        self._message_ids = iter(range(10 ** 6, 10 ** 9))
+
+    def start(self):
+        self.outbox.start()
+
+    def stop(self):
+        self.outbox.stop()
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _send_message(self, chat_id):
+        self._call()
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self._message_ids))
+
+    def _send_photo(self, chat_id):
+        self._call()
+        message_id = next(self._message_ids)
+        return SimpleNamespace(chat_id=chat_id, message_id=message_id,
+                               photo=[SimpleNamespace(file_id=f'photo-{message_id}')])
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(chat_id, self._send_message, chat_id)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(chat_id, self._send_photo, chat_id)
+
+    def delete_message(self, *args, **kwargs):
+        return True
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self.outbox.submit_unordered(self._call)
+
+    answerCallbackQuery = answer_callback_query
+
+
+def make_journey(user_id, number, product_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    steps = itertools.count()
+
+    def message(text, entities=None):
+        message = {'message_id': 1, 'date': int(time.time()), 'from': user, 'chat': chat, 'text': text}
+        if entities:
+            message['entities'] = entities
+        return {'message': message}
+
+    def callback(data):
+        return {'callback_query': {'id': f'{user_id}-{number}-{next(steps)}', 'from': user,
+                                   'chat_instance': str(user_id), 'data': data,
+                                   'message': {'message_id': 1, 'date': int(time.time()),
+                                               'from': user, 'chat': chat}}}
+
+    return [message('/start', [{'type': 'bot_command', 'offset': 0, 'length': 6}]),
+            callback(product_id),
+            callback(f'add_to_cart {product_id} 3'),
+            callback('cart_info'),
+            callback(f'remove_item {product_id}'),
+            callback('remove_all'),
+            callback('menu'),
+            callback(product_id),
+            callback(f'add_to_cart {product_id} 3'),
+            callback('cart_info'),
+            callback('checkout'),
+            message(f'user{user_id}-{number}@example.com')]
+
+
+def instrument(conv_handler, recorder):
+    handlers = list(conv_handler.entry_points) + list(conv_handler.fallbacks)
+    for state_handlers in conv_handler.states.values():
+        handlers.extend(state_handlers)
+    for handler in handlers:
+        callback = handler.callback
+        name = getattr(callback, 'func', callback).__name__
+        handler.callback = recorder.timed(name, callback)
+
+
+def run(args):
+    server = MockElasticPathServer(store=MockStore(args.products),
+                                   latency=args.latency / 1000,
+                                   jitter=args.jitter / 1000,
+                                   error_rate=args.error_rate)
+    server.start()
+    elastic_client = ElasticPathClient('store', 'client', 'secret', base_url=server.url,
+                                       pool_size=args.pool_size, backoff_factor=0,
+                                       rate_limit=args.elastic_rate_limit, burst=args.elastic_rate_limit)
+    photo_cache = PhotoCache(':memory:')
+    product_cache = ProductCache(partial(load_product_card,
+                                         elastic_client=elastic_client,
+                                         photo_cache=photo_cache),
+                                 ttl=args.catalog_ttl)
+    menu_cache = CatalogCache(partial(prefetch_catalog, elastic_client, product_cache, photo_cache),
+                              ttl=args.catalog_ttl)
+    if args.prefetch:
+        menu_cache.get()
+    cart_store = CartStore(elastic_client)
+    cart_store.start()
+    recorder = LatencyRecorder()
+    bot = FakeBot(args.tg_latency / 1000)
+    bot.start()
+    checkout_pipeline = CheckoutPipeline(elastic_client, notify=recorder.timed('follow_up', bot.send_message))
+    checkout_pipeline.start()
+    conv_handler = build_conversation_handler(checkout_pipeline, menu_cache, product_cache, photo_cache, cart_store)
+    instrument(conv_handler, recorder)
+    dispatcher = Dispatcher(bot, Queue(), workers=0)
+    dispatcher.add_handler(conv_handler)
+    product_ids = list(server.store.products)
+
+    def run_user(user_id):
+        update_id = user_id * 10 ** 6
+        for number in range(args.journeys):
+            for raw_update in make_journey(user_id, number, product_ids[(user_id + number) % len(product_ids)]):
+                update_id += 1
+                raw_update['update_id'] = update_id
+                recorder.timed('update', dispatcher.process_update)(Update.de_json(raw_update, bot))
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(run_user, range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started_at
+    checkout_pipeline.stop()
+    bot.stop()
+    cart_store.stop()
+    elastic_client.close()
+    photo_cache.close()
+    server.shutdown()
+    updates = len(recorder.samples.get('update', []))
+    return {'config': vars(args),
+            'updates': updates,
+            'elapsed': elapsed,
+            'updates_per_second': updates / elapsed,
+            'handlers': recorder.summary()}
+
+
+def print_report(result):
+    print(f'{"handler":<28}{"count":>8}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, stats in result['handlers'].items():
+        print(f'{name:<28}{stats["count"]:>8}{stats["errors"]:>8}'
+              f'{stats["p50"]:>10.1f}{stats["p95"]:>10.1f}{stats["p99"]:>10.1f}')
+    print(f'\n{result["updates"]} updates in {result["elapsed"]:.2f}s, '
+          f'{result["updates_per_second"]:.1f} updates/sec')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot against a mock Elastic Path')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--journeys', type=int, default=5, help='journeys per user')
+    parser.add_argument('--workers', type=int, default=8, help='threads processing updates')
+    parser.add_argument('--pool-size', type=int, default=32, help='Elastic Path connection pool size')
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=30.0, help='Elastic Path latency, ms')
+    parser.add_argument('--jitter', type=float, default=5.0, help='Elastic Path latency deviation, ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Elastic Path errors')
+    parser.add_argument('--elastic-rate-limit', type=float, default=1000.0, help='Elastic Path requests per second')
+    parser.add_argument('--tg-latency', type=float, default=20.0, help='Telegram API latency, ms')
+    parser.add_argument('--catalog-ttl', type=int, default=600)
+    parser.add_argument('--prefetch', action='store_true', help='load the catalog and product cards before the run')
+    parser.add_argument('--json', help='write the results to this file for comparison between runs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
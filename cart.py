@@ -0,0 +1,270 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+import requests
+
+from elasticpath import (CatalogCache,
+                         add_product_to_cart,
+                         delete_product_from_cart,
+                         get_cart_items,
+                         get_currencies,
+                         remove_all_from_cart)
+
+logger = logging.getLogger(__name__)
+
+
+def get_currency_format(currencies, code):
+    return currencies.get(code) or {'format': f'{{price}} {code}'.rstrip(),
+                                    'decimal_point': '.',
+                                    'thousand_separator': ',',
+                                    'decimal_places': 2}
+
+
+def get_default_currency(currencies):
+    return next((code for code, currency_format in currencies.items() if currency_format.get('default')), '')
+
+
+def format_price(amount, currency_format):
+    places = currency_format['decimal_places']
+    number = f'{amount / 10 ** places:,.{places}f}'.translate(
+        str.maketrans({',': currency_format['thousand_separator'], '.': currency_format['decimal_point']}))
+    return currency_format['format'].replace('{price}', number)
+
+
+class CartOperations:
+    def __init__(self):
+        self.clear = False
+        self.removes = set()
+        self.adds = {}
+
+    def __bool__(self):
+        return self.clear or bool(self.removes) or bool(self.adds)
+
+    def add(self, product_id, quantity):
+        self.adds[product_id] = self.adds.get(product_id, 0) + quantity
+
+    def remove(self, product_id):
+        self.adds.pop(product_id, None)
+        self.removes.add(product_id)
+
+    def remove_all(self):
+        self.clear = True
+        self.removes.clear()
+        self.adds.clear()
+
+    def merge(self, newer):
+        if newer.clear:
+            return newer
+        for product_id in newer.removes:
+            self.remove(product_id)
+        for product_id, quantity in newer.adds.items():
+            self.add(product_id, quantity)
+        return self
+
+
+class LocalCart:
+    def __init__(self, items):
+        self.items = {}
+        self.pending = CartOperations()
+        self.version = 0
+        self.flushing = False
+        self.loaded_at = 0
+        self.replace(items)
+
+    def is_idle(self):
+        return not self.pending and not self.flushing
+
+    def add(self, product_id, product_info, quantity):
+        item = self.items.setdefault(product_id, {'item_id': None,
+                                                  'name': product_info['product_name'],
+                                                  'qty': 0,
+                                                  'amount': product_info['product_amount'],
+                                                  'currency': product_info['product_currency']})
+        item['qty'] += quantity
+        self.pending.add(product_id, quantity)
+        self.version += 1
+
+    def remove(self, product_id):
+        self.items.pop(product_id, None)
+        self.pending.remove(product_id)
+        self.version += 1
+
+    def remove_all(self):
+        self.items.clear()
+        self.pending.remove_all()
+        self.version += 1
+
+    def replace(self, items):
+        self.items = {}
+        self.loaded_at = time()
+        for item in items:
+            product_id = item['product_id'] or item['id']
+            self.items[product_id] = {'item_id': item['id'],
+                                      'name': item['name'],
+                                      'qty': item['qty'],
+                                      'amount': item['amount'],
+                                      'currency': item['currency']}
+
+    def render(self, currencies):
+        products = []
+        total = 0
+        currency = get_default_currency(currencies)
+        for product_id, item in self.items.items():
+            currency_format = get_currency_format(currencies, item['currency'])
+            subtotal = item['amount'] * item['qty']
+            total += subtotal
+            currency = item['currency']
+            products.append({'id': product_id,
+                             'name': item['name'],
+                             'qty': item['qty'],
+                             'price': format_price(item['amount'], currency_format),
+                             'subtotal': format_price(subtotal, currency_format)})
+        return products, format_price(total, get_currency_format(currencies, currency))
+
+
+class CartStore:
+    def __init__(self, elastic_client, flush_delay=0.5, workers=4, maxsize=10000, ttl=300, currency_ttl=3600):
+        self.elastic_client = elastic_client
+        self.currencies = CatalogCache(partial(get_currencies, elastic_client), ttl=currency_ttl, name='currencies')
+        self.flush_delay = flush_delay
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._carts = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cart-flush')
+        self._thread = threading.Thread(target=self._run, daemon=True, name='cart-flusher')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._flush_dirty()
+        self._executor.shutdown()
+
+    def get_items(self, user_id):
+        cart = self._load(user_id)
+        currencies = self._get_currencies()
+        with self._lock:
+            return self._carts.setdefault(user_id, cart).render(currencies)
+
+    def add(self, user_id, product_id, product_info, quantity):
+        cart = self._load(user_id)
+        with self._lock:
+            self._carts.setdefault(user_id, cart).add(product_id, product_info, quantity)
+            self._dirty.add(user_id)
+
+    def remove(self, user_id, product_id):
+        cart = self._load(user_id)
+        with self._lock:
+            self._carts.setdefault(user_id, cart).remove(product_id)
+            self._dirty.add(user_id)
+
+    def remove_all(self, user_id):
+        cart = self._load(user_id)
+        with self._lock:
+            self._carts.setdefault(user_id, cart).remove_all()
+            self._dirty.add(user_id)
+
+    def _load(self, user_id):
+        with self._lock:
+            cart = self._carts.get(user_id)
+            if cart is not None:
+                self._carts.move_to_end(user_id)
+                if time() - cart.loaded_at < self.ttl or not cart.is_idle():
+                    return cart
+                version = cart.version
+        try:
+            items, _ = get_cart_items(self.elastic_client, user_id)
+        except Exception:
+            if cart is None:
+                raise
+            logger.exception('Cart %s reload failed, using the cached copy', user_id)
+            return cart
+        with self._lock:
+            if cart is None:
+                cart = self._carts.setdefault(user_id, LocalCart(items))
+                self._evict()
+            elif cart.version == version and cart.is_idle():
+                cart.replace(items)
+        return cart
+
+    def _get_currencies(self):
+        try:
+            return self.currencies.get()
+        except Exception:
+            logger.exception('Could not load the currency formats')
+            return {}
+
+    def _evict(self):
+        for user_id in list(self._carts):
+            if len(self._carts) <= self.maxsize:
+                return
+            if self._carts[user_id].is_idle():
+                del self._carts[user_id]
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_delay):
+            self._flush_dirty()
+
+    def _flush_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for future in [self._executor.submit(self._flush, user_id) for user_id in dirty]:
+            future.result()
+
+    def _flush(self, user_id):
+        with self._lock:
+            cart = self._carts[user_id]
+            operations, cart.pending = cart.pending, CartOperations()
+            cart.flushing = True
+            item_ids = {product_id: item['item_id'] for product_id, item in cart.items.items()}
+        try:
+            self._apply(user_id, operations, item_ids)
+        except requests.HTTPError:
+            logger.exception('Cart %s flush was rejected, reloading it from Elastic Path', user_id)
+        except Exception:
+            logger.exception('Cart %s flush failed, will retry', user_id)
+            with self._lock:
+                cart.pending = operations.merge(cart.pending)
+                cart.flushing = False
+                self._dirty.add(user_id)
+            return
+        self._reconcile(user_id, cart)
+
+    def _apply(self, user_id, operations, item_ids):
+        if operations.clear:
+            remove_all_from_cart(self.elastic_client, user_id)
+            operations.clear = False
+        if operations.removes:
+            upstream_items, _ = get_cart_items(self.elastic_client, user_id)
+            item_ids.update({item['product_id']: item['id'] for item in upstream_items})
+        while operations.removes:
+            product_id = next(iter(operations.removes))
+            if item_ids.get(product_id):
+                delete_product_from_cart(self.elastic_client, user_id, item_ids[product_id])
+            operations.removes.discard(product_id)
+        while operations.adds:
+            product_id, quantity = next(iter(operations.adds.items()))
+            add_product_to_cart(self.elastic_client, user_id, product_id, quantity)
+            del operations.adds[product_id]
+
+    def _reconcile(self, user_id, cart):
+        with self._lock:
+            version = cart.version
+        try:
+            items, _ = get_cart_items(self.elastic_client, user_id)
+        except Exception:
+            logger.exception('Cart %s reconciliation failed', user_id)
+            items = None
+        with self._lock:
+            cart.flushing = False
+            if items is not None and cart.version == version and not cart.pending:
+                cart.replace(items)
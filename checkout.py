@@ -0,0 +1,165 @@
+import logging
+import re
+import threading
+from queue import Empty, Queue
+from time import monotonic
+
+from elasticpath import create_customer
+
+logger = logging.getLogger(__name__)
+
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s.]+')
+
+CREATED = 'created'
+EXISTS = 'exists'
+REJECTED = 'rejected'
+FAILED = 'failed'
+
+FOLLOW_UPS = {CREATED: 'Thank you! We have registered {email} and will contact you shortly.',
+              EXISTS: 'You are already registered with {email}. We will contact you shortly.',
+              REJECTED: 'We could not register {email}. Please check it and send it again.',
+              FAILED: 'Sorry, we could not register {email} right now. Please try again later.'}
+
+
+def is_valid_email(email):
+    return len(email) <= 254 and EMAIL_PATTERN.fullmatch(email) is not None
+
+
+def get_customer_result(status):
+    if status == 201:
+        return CREATED
+    if status == 409:
+        return EXISTS
+    if 400 <= status < 500 and status != 429:
+        return REJECTED
+    return None
+
+
+class CustomerJob:
+    def __init__(self, email, name, password, chat_id):
+        self.email = email
+        self.name = name
+        self.password = password
+        self.chat_ids = [chat_id]
+        self.attempt = 0
+
+
+def collapse_jobs(batch, find_retrying, customers):
+    jobs = {}
+    known = []
+    for job in batch:
+        retrying = find_retrying(job.email)
+        if retrying is not None and retrying is not job:
+            retrying.chat_ids.extend(job.chat_ids)
+        elif job.email in jobs:
+            jobs[job.email].chat_ids.extend(job.chat_ids)
+        elif customers.get(job.email):
+            known.append(job)
+        else:
+            jobs[job.email] = job
+    return list(jobs.values()), known
+
+
+class CheckoutPipeline:
+    def __init__(self, elastic_client, notify, customers=None, batch_size=20, batch_delay=0.2,
+                 retries=3, retry_delay=1.0):
+        self.elastic_client = elastic_client
+        self.notify = notify
+        self.customers = {} if customers is None else customers
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = Queue()
+        self._retrying = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='checkout')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        with self._lock:
+            retrying, self._retrying = self._retrying, {}
+        for job, timer in retrying.values():
+            timer.cancel()
+            job.attempt = self.retries
+        if retrying:
+            self._process([job for job, _ in retrying.values()])
+
+    def submit(self, chat_id, name, email, password):
+        self._queue.put(CustomerJob(email.strip().lower(), name, password, chat_id))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if job is None:
+                    self._process_batch(batch)
+                    return
+                batch.append(job)
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        try:
+            self._process(batch)
+        except Exception:
+            logger.exception('Checkout batch of %s customers failed', len(batch))
+
+    def _process(self, batch):
+        jobs, known = collapse_jobs(batch, self._find_retrying, self.customers)
+        for job in known:
+            self._notify(job, EXISTS)
+        futures = [(job, self.elastic_client.executor.submit(create_customer, self.elastic_client,
+                                                             job.name, job.email, job.password))
+                   for job in jobs]
+        for job, future in futures:
+            try:
+                result = get_customer_result(future.result())
+            except Exception:
+                logger.exception('Could not create customer %s', job.email)
+                result = None
+            if result is None:
+                self._retry(job)
+            else:
+                self._finish(job, result)
+
+    def _find_retrying(self, email):
+        with self._lock:
+            retrying = self._retrying.get(email)
+        return retrying[0] if retrying is not None else None
+
+    def _retry(self, job):
+        if job.attempt >= self.retries:
+            self._finish(job, FAILED)
+            return
+        job.attempt += 1
+        timer = threading.Timer(self.retry_delay * 2 ** (job.attempt - 1), self._queue.put, (job,))
+        timer.daemon = True
+        with self._lock:
+            self._retrying[job.email] = (job, timer)
+        timer.start()
+
+    def _finish(self, job, result):
+        with self._lock:
+            self._retrying.pop(job.email, None)
+        if result in (CREATED, EXISTS):
+            self.customers[job.email] = result
+        self._notify(job, result)
+
+    def _notify(self, job, result):
+        for chat_id in job.chat_ids:
+            try:
+                self.notify(chat_id, FOLLOW_UPS[result].format(email=job.email))
+            except Exception:
+                logger.exception('Could not send the checkout result to chat %s', chat_id)
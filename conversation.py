@@ -0,0 +1,10 @@
+from enum import Enum, auto
+
+
+class State(Enum):
+    START = auto()
+    HANDLE_MENU = auto()
+    HANDLE_DESCRIPTION = auto()
+    HANDLE_CART = auto()
+    WAITING_EMAIL = auto()
+
@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+from metrics import DUPLICATE_UPDATES
+
+
+class ExpiringSet:
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        now = time()
+        with self._lock:
+            while self._entries:
+                oldest_key, expires_at = next(iter(self._entries.items()))
+                if expires_at > now:
+                    break
+                del self._entries[oldest_key]
+            if key in self._entries:
+                return False
+            self._entries[key] = now + self.ttl
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+
+class UpdateDeduplicator:
+    def __init__(self, update_ttl=600, callback_window=1.0, maxsize=10000):
+        self.updates = ExpiringSet(maxsize, update_ttl)
+        self.callbacks = ExpiringSet(maxsize, callback_window)
+
+    def is_duplicate(self, update_id, user_id=None, callback_data=None):
+        if not self.updates.add(update_id):
+            DUPLICATE_UPDATES.inc(kind='update')
+            return True
+        if callback_data is not None and not self.callbacks.add((user_id, callback_data)):
+            DUPLICATE_UPDATES.inc(kind='callback')
+            return True
+        return False
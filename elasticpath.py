@@ -1,158 +1,571 @@
 import json
+import logging
 import requests
-import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from time import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from ratelimit import RateLimiter
+from metrics import CACHE_REQUESTS, ELASTICPATH_RESPONSES, TOKEN_REFRESHES, track_call
 
-def get_all_products(token, store_id):
-    url = 'https://useast.api.elasticpath.com/pcm/products'
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': store_id,
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("GET", url, headers=headers)
+logger = logging.getLogger(__name__)
+
+
+class ElasticPathClient:
+    def __init__(self, store_id, client_id, client_secret,
+                 base_url='https://useast.api.elasticpath.com',
+                 pool_size=10,
+                 timeout=(3.05, 10),
+                 retries=3,
+                 backoff_factor=0.3,
+                 workers=8,
+                 rate_limit=10,
+                 burst=10):
+        self.store_id = store_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limiter = RateLimiter(rate_limit, burst, name='elasticpath')
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'accept': 'application/json',
+                                     'content-type': 'application/json',
+                                     'x-moltin-auth-store': str(store_id)})
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='elasticpath')
+        self.tokens = TokenManager(partial(update_elastic_token, self))
+
+    def request(self, method, path, auth=True, **kwargs):
+        headers = kwargs.pop('headers', {})
+        kwargs.setdefault('timeout', self.timeout)
+        url = f'{self.base_url}{path}'
+        if not auth:
+            return self._send(method, url, headers, **kwargs)
+        token = self.tokens.get()
+        headers['Authorization'] = f'Bearer {token}'
+        response = self._send(method, url, headers, **kwargs)
+        if response.status_code == 401:
+            self.tokens.invalidate(token)
+            headers['Authorization'] = f'Bearer {self.tokens.get()}'
+            response = self._send(method, url, headers, **kwargs)
+        return response
+
+    def _send(self, method, url, headers, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            ELASTICPATH_RESPONSES.inc(method=method, status=response.status_code)
+            if response.status_code != 429 or attempt == self.retries:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() else self.backoff_factor * (2 ** attempt)
+            logger.warning('Elastic Path rate limit hit, retrying in %s seconds', delay)
+            self.limiter.pause(delay)
+
+    def close(self):
+        self.tokens.close()
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class TokenManager:
+    def __init__(self, fetch, refresh_margin=60, expiry_margin=5, retry_delay=5):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.expiry_margin = expiry_margin
+        self.retry_delay = retry_delay
+        self._token = None
+        self._expires_at = 0
+        self._refreshing = None
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        token, expires_at = self._token, self._expires_at
+        if token is not None and time() < expires_at - self.expiry_margin:
+            return token
+        with self._lock:
+            if self._token is not None and time() < self._expires_at - self.expiry_margin:
+                return self._token
+            refreshing = self._refreshing
+            if refreshing is None:
+                refreshing = self._refreshing = Future()
+                owner = True
+            else:
+                owner = False
+        if owner:
+            self._refresh(refreshing)
+        return refreshing.result()
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+
+    def _refresh(self, refreshing):
+        try:
+            token, expires_at = self.fetch()
+        except Exception as error:
+            TOKEN_REFRESHES.inc(result='error')
+            with self._lock:
+                self._refreshing = None
+            refreshing.set_exception(error)
+            return
+        TOKEN_REFRESHES.inc(result='ok')
+        with self._lock:
+            self._token, self._expires_at = token, expires_at
+            self._refreshing = None
+            self._schedule(expires_at - self.refresh_margin - time())
+        refreshing.set_result(token)
+
+    def _schedule(self, delay):
+        if self._closed:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            if self._closed or self._refreshing is not None or time() < self._expires_at - self.refresh_margin:
+                return
+            refreshing = self._refreshing = Future()
+        self._refresh(refreshing)
+        if refreshing.exception() is not None:
+            logger.error('Elastic Path token refresh failed', exc_info=refreshing.exception())
+            with self._lock:
+                self._schedule(self.retry_delay)
+
+
+class CatalogCache:
+    def __init__(self, loader, ttl=600, name='catalog', refresh_interval=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.name = name
+        self.refresh_interval = refresh_interval
+        self._value = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'{name}-refresh')
+
+    def start(self):
+        self.warm()
+        if self.refresh_interval:
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def get(self):
+        with self._lock:
+            if self._value is not None:
+                if time() >= self._expires_at and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._background_refresh, daemon=True).start()
+                CACHE_REQUESTS.inc(cache=self.name, result='hit')
+                return self._value
+        CACHE_REQUESTS.inc(cache=self.name, result='miss')
+        with self._load_lock:
+            if self._value is None:
+                self._refresh()
+            return self._value
+
+    def warm(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def invalidate(self):
+        with self._lock:
+            self._expires_at = 0
+
+    def _refresh(self):
+        value = self.loader()
+        with self._lock:
+            self._value = value
+            self._expires_at = time() + self.ttl
+
+    def _background_refresh(self):
+        try:
+            with self._load_lock:
+                self._refresh()
+        except Exception:
+            logger.exception('Catalog refresh failed, serving stale data')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            self.warm()
+
+
+class ProductCache:
+    def __init__(self, loader, maxsize=256, ttl=600, name='product'):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.capacity = maxsize
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time():
+                self._entries.move_to_end(key)
+                CACHE_REQUESTS.inc(cache=self.name, result='hit')
+                return entry[1]
+            CACHE_REQUESTS.inc(cache=self.name, result='miss')
+            future = self._pending.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._pending[key] = future
+        if not is_owner:
+            return future.result()
+        try:
+            value = self.loader(key)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(value)
+            self.set(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def set_many(self, items):
+        with self._lock:
+            self.capacity = len(items) + self.maxsize
+            expires_at = time() + self.ttl
+            for key, value in items.items():
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class ProductRecord:
+    __slots__ = ('id', 'name', 'sku', 'price', 'category')
+
+    def __init__(self, id, name, sku, price, category):
+        self.id = id
+        self.name = name
+        self.sku = sku
+        self.price = price
+        self.category = category
+
+
+class CatalogIndex:
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda record: record.name.lower())
+        self._names = [record.name.lower() for record in self.records]
+        self._by_sku = sorted((record for record in self.records if record.sku),
+                              key=lambda record: record.sku.lower())
+        self._skus = [record.sku.lower() for record in self._by_sku]
+
+    def __len__(self):
+        return len(self.records)
+
+    def pages(self, page_size):
+        return max((len(self.records) + page_size - 1) // page_size, 1)
+
+    def page(self, number, page_size):
+        return self.records[number * page_size:(number + 1) * page_size]
+
+    def search(self, prefix, limit):
+        prefix = prefix.strip().lower()
+        found = {}
+        for keys, records in ((self._names, self.records), (self._skus, self._by_sku)):
+            position = bisect_left(keys, prefix)
+            while position < len(keys) and keys[position].startswith(prefix) and len(found) < limit:
+                found.setdefault(records[position].id, records[position])
+                position += 1
+        return list(found.values())
+
+
+def parse_product_record(product):
+    meta = product.get('meta', {})
+    price = meta.get('display_price', {}).get('with_tax', {}).get('formatted')
+    category = (meta.get('bread_crumb_nodes') or [None])[0]
+    return ProductRecord(product['id'],
+                         product['attributes']['name'],
+                         product['attributes'].get('sku'),
+                         price,
+                         category)
+
+
+@track_call
+def get_all_products(client):
+    response = client.request("GET", '/pcm/products')
     response.raise_for_status()
     return response.json()['data']
 
 
-def get_cart_items(token, cart_id, store_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{cart_id}/items'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': store_id,
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("GET", url, headers=headers, data=payload)
+@track_call
+def get_catalog_page(client, offset, limit):
+    params = {'page[offset]': offset, 'page[limit]': limit}
+    response = client.request("GET", '/catalog/products', params=params)
     response.raise_for_status()
-    products_in_cart = response.json()
+    return response.json()
+
+
+@track_call
+def get_pcm_page(client, offset, limit):
+    params = {'page[offset]': offset, 'page[limit]': limit, 'include': 'files'}
+    response = client.request("GET", '/pcm/products', params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_pages(client, get_page, page_size=100):
+    first_page = get_page(client, 0, page_size)
+    yield first_page
+    total = first_page['meta']['results']['total']
+    pages = [client.executor.submit(get_page, client, offset, page_size)
+             for offset in range(page_size, total, page_size)]
+    for page in pages:
+        yield page.result()
+
+
+def iter_catalog_products(client, page_size=100):
+    for page in iter_pages(client, get_catalog_page, page_size):
+        yield from page['data']
+
+
+def parse_product_cards(catalog_products, pcm_pages):
+    pcm_products = {}
+    file_links = {}
+    for page in pcm_pages:
+        for product in page['data']:
+            pcm_products[product['id']] = product
+        for file in page.get('included', {}).get('files', []):
+            file_links[file['id']] = file['link']['href']
+    product_cards = {}
+    for product in catalog_products:
+        pcm_product = pcm_products.get(product['id'], {})
+        files = pcm_product.get('relationships', {}).get('files', {}).get('data')
+        if not files:
+            continue
+        product_card = parse_product_info({'data': product}, {'data': pcm_product})
+        product_card['photo_id'] = files[0]['id']
+        product_card['photo_link'] = file_links.get(files[0]['id'])
+        product_cards[product['id']] = product_card
+    return product_cards
+
+
+def load_catalog(client, page_size=100):
+    catalog_products = list(iter_catalog_products(client, page_size))
+    product_cards = parse_product_cards(catalog_products, iter_pages(client, get_pcm_page, page_size))
+    missing_links = {card['photo_id'] for card in product_cards.values() if card['photo_link'] is None}
+    file_links = dict(zip(missing_links, client.executor.map(partial(get_file_link, client), missing_links)))
+    for product_card in product_cards.values():
+        product_card['photo_link'] = product_card['photo_link'] or file_links[product_card['photo_id']]
+    return CatalogIndex([parse_product_record(product) for product in catalog_products]), product_cards
+
+
+@track_call
+def get_cart_items(client, cart_id):
+    response = client.request("GET", f'/v2/carts/{cart_id}/items')
+    response.raise_for_status()
+    return parse_cart_items(response.json())
+
+
+def parse_cart_items(products_in_cart):
     products = []
     for product in products_in_cart['data']:
         products.append({'id': product['id'],
+                         'product_id': product.get('product_id'),
                          'name': product['name'],
                          'qty': product['quantity'],
                          'price': product['meta']['display_price']['with_tax']['unit']['formatted'],
+                         'amount': product['meta']['display_price']['with_tax']['unit']['amount'],
+                         'currency': product['meta']['display_price']['with_tax']['unit']['currency'],
                          'subtotal': product['meta']['display_price']['with_tax']['value']['formatted']})
     total_price = products_in_cart['meta']['display_price']['with_tax']['formatted']
     return products, total_price
 
 
-def add_product_to_cart(token, cart_id, store_id, product_id, quantity: int):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{cart_id}/items'
+@track_call
+def get_currencies(client):
+    response = client.request("GET", '/v2/currencies')
+    response.raise_for_status()
+    return parse_currencies(response.json())
+
+
+def parse_currencies(payload):
+    return {currency['code']: {'format': currency['format'],
+                               'decimal_point': currency['decimal_point'],
+                               'thousand_separator': currency['thousand_separator'],
+                               'decimal_places': currency['decimal_places'],
+                               'default': currency.get('default', False)}
+            for currency in payload['data']}
+
+
+@track_call
+def add_product_to_cart(client, cart_id, product_id, quantity: int):
     payload = json.dumps({"data": {'id': product_id,
                                    'type': "cart_item",
                                    'quantity': quantity}})
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': store_id,
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = client.request("POST", f'/v2/carts/{cart_id}/items', data=payload)
     response.raise_for_status()
     return response.json()
 
 
-def delete_product_from_cart(token, cart_id, store_id, product_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{cart_id}/items/{product_id}'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': store_id,
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("DELETE", url, headers=headers, data=payload)
+@track_call
+def delete_product_from_cart(client, cart_id, product_id):
+    response = client.request("DELETE", f'/v2/carts/{cart_id}/items/{product_id}')
     response.raise_for_status()
     return response.json()
 
 
-def remove_all_from_cart(token, cart_id, store_id):
-    url = f'https://useast.api.elasticpath.com/v2/carts/{cart_id}/items'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': f'{store_id}',
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("DELETE", url, headers=headers, data=payload)
+@track_call
+def remove_all_from_cart(client, cart_id):
+    response = client.request("DELETE", f'/v2/carts/{cart_id}/items')
     response.raise_for_status()
     return response
 
 
-def get_product_info_by_id(token, product_id, store_id):
-    url_info = f'https://useast.api.elasticpath.com/catalog/products/{product_id}'
-    url_description = f'https://useast.api.elasticpath.com/pcm/products/{product_id}'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': f'{store_id}',
-               'Authorization': f'Bearer {token}'}
-    response_info = requests.request("GET", url_info, headers=headers, data=payload)
-    response_info.raise_for_status()
-    product_info = response_info.json()
-    response_description = requests.request("GET", url_description, headers=headers, data=payload)
-    response_description.raise_for_status()
-    product_description = response_description.json()
+@track_call
+def get_catalog_product(client, product_id):
+    response = client.request("GET", f'/catalog/products/{product_id}')
+    response.raise_for_status()
+    return response.json()
+
+
+@track_call
+def get_pcm_product(client, product_id, include=None):
+    params = {'include': include} if include else None
+    response = client.request("GET", f'/pcm/products/{product_id}', params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+@track_call
+def get_product_info_by_id(client, product_id):
+    product_info = client.executor.submit(get_catalog_product, client, product_id)
+    product_description = get_pcm_product(client, product_id)
+    return parse_product_info(product_info.result(), product_description)
+
+
+def parse_product_info(product_info, product_description):
     response = {'product_name': product_info['data']['attributes']['name'],
                 'product_price': product_info['data']['meta']['display_price']['with_tax']['formatted'],
+                'product_amount': product_info['data']['meta']['display_price']['with_tax']['amount'],
+                'product_currency': product_info['data']['meta']['display_price']['with_tax']['currency'],
                 'product_sku': product_info['data']['attributes']['sku'],
                 'product_description': product_description['data']['attributes']['description']}
     return response
 
 
-def get_photo_by_productid(token, product_id, store_id):
-    url_get_fileid = f'https://useast.api.elasticpath.com/pcm/products/{product_id}/relationships/files'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': f'{store_id}',
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("GET", url_get_fileid, headers=headers, data=payload)
-    file_id = response.json()['data'][0]['id']
-
-    url_get_photo = f'https://useast.api.elasticpath.com/v2/files/{file_id}'
-    payload = {}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': f'{store_id}',
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("GET", url_get_photo, headers=headers, data=payload)
+@track_call
+def get_product_card(client, product_id):
+    product_info = client.executor.submit(get_catalog_product, client, product_id)
+    product_description = get_pcm_product(client, product_id, include='files')
+    product_card = parse_product_info(product_info.result(), product_description)
+    product_card['photo_id'], product_card['photo_link'] = parse_product_file(product_description)
+    if product_card['photo_link'] is None:
+        product_card['photo_link'] = get_file_link(client, product_card['photo_id'])
+    return product_card
+
+
+def parse_product_file(pcm_product):
+    file_id = pcm_product['data']['relationships']['files']['data'][0]['id']
+    file_links = {file['id']: file['link']['href'] for file in pcm_product.get('included', {}).get('files', [])}
+    return file_id, file_links.get(file_id)
+
+
+@track_call
+def get_product_file_id(client, product_id):
+    response = client.request("GET", f'/pcm/products/{product_id}/relationships/files')
+    response.raise_for_status()
+    return response.json()['data'][0]['id']
+
+
+@track_call
+def get_file_link(client, file_id):
+    response = client.request("GET", f'/v2/files/{file_id}')
     response.raise_for_status()
-    file_link = response.json()['data']['link']['href']
-    return file_link
+    return response.json()['data']['link']['href']
+
 
+@track_call
+def get_photo_by_productid(client, product_id):
+    file_id = get_product_file_id(client, product_id)
+    return get_file_link(client, file_id)
 
-def create_customer(name, email, password, store_id, token):
-    url = f'https://useast.api.elasticpath.com/v2/customers'
+
+@track_call
+def create_customer(client, name, email, password):
     payload = json.dumps({"data": {
         "type": "customer",
         "name": str(name),
         "email": str(email),
         "password": str(password)}})
-    headers = {'accept': 'application/json',
-               'content-type': 'application/json',
-               'x-moltin-auth-store': store_id,
-               'Authorization': f'Bearer {token}'}
-    response = requests.request("POST", url, headers=headers, data=payload)
-    return response.status_code == 201
-
-
-def update_elastic_token(client_id, client_secret, store_id):
-    url = 'https://useast.api.elasticpath.com/oauth/access_token'
-    payload = {'client_id': client_id,
-               'client_secret': client_secret,
+    response = client.request("POST", '/v2/customers', data=payload)
+    return response.status_code
+
+
+@track_call
+def update_elastic_token(client):
+    payload = {'client_id': client.client_id,
+               'client_secret': client.client_secret,
                'grant_type': 'client_credentials'}
-    headers = {'accept': 'application/json',
-               'content-type': 'application/x-www-form-urlencoded',
-               'x-moltin-auth-store': store_id}
-    response = requests.request("POST", url, headers=headers, data=payload)
+    headers = {'content-type': 'application/x-www-form-urlencoded'}
+    response = client.request("POST", '/oauth/access_token', auth=False, headers=headers, data=payload)
     response.raise_for_status()
     response_credentials = response.json()
     token = response_credentials['access_token']
     token_lifetime = response_credentials['expires']
-    os.environ["ELASTIC_TOKEN"] = str(token)
-    os.environ["ELASTIC_TOKEN_LIFETIME"] = str(token_lifetime)
-    return os.getenv('ELASTIC_TOKEN')
-
-
-def check_elastic_token():
-    if os.getenv("ELASTIC_TOKEN_LIFETIME") is not None:
-        token_lifetime = float(os.getenv("ELASTIC_TOKEN_LIFETIME")) - time()
-        return token_lifetime < 5
-    else:
-        return True
+    return token, float(token_lifetime)
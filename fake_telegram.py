@@ -0,0 +1,73 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def make_updates(chats, per_chat, product_id):
+    updates = []
+    update_id = 1
+    for number in range(per_chat):
+        for chat_id in range(1, chats + 1):
+            user = {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}
+            chat = {'id': chat_id, 'type': 'private'}
+            message = {'message_id': update_id, 'date': int(time.time()), 'from': user, 'chat': chat}
+            if number == 0:
+                update = {'message': dict(message, text='/start',
+                                          entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])}
+            else:
+                update = {'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': str(chat_id),
+                                             'message': message, 'data': product_id}}
+            update['update_id'] = update_id
+            updates.append(update)
+            update_id += 1
+    return updates
+
+
+def get_chat_id(update):
+    payload = update.get('message') or update['callback_query']['message']
+    return payload['chat']['id']
+
+
+def post_updates(url, updates, concurrency=8):
+    session = requests.Session()
+    chats = {}
+    for update in updates:
+        chats.setdefault(get_chat_id(update), []).append(update)
+
+    def post_chat(chat_updates):
+        statuses = []
+        for update in chat_updates:
+            while True:
+                response = session.post(url, data=json.dumps(update),
+                                        headers={'content-type': 'application/json'})
+                if response.status_code != 503:
+                    break
+                time.sleep(float(response.headers.get('Retry-After', 1)))
+            statuses.append(response.status_code)
+        return statuses
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [status for statuses in executor.map(post_chat, chats.values()) for status in statuses]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post synthetic Telegram updates to a local webhook')
+    parser.add_argument('url')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--per-chat', type=int, default=5)
+    parser.add_argument('--product-id', default='product')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+    updates = make_updates(args.chats, args.per_chat, args.product_id)
+    started_at = time.time()
+    statuses = post_updates(args.url, updates, args.concurrency)
+    elapsed = time.time() - started_at
+    print(f'Posted {len(statuses)} updates in {elapsed:.2f}s, '
+          f'{statuses.count(200)} accepted')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}\n', f'# TYPE {self.name} counter\n']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}\n')
+        return ''.join(lines)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}\n', f'# TYPE {self.name} histogram\n']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                labels = dict(zip(self.labelnames, key))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels(dict(labels, le=bound))} {bucket_count}\n')
+                lines.append(f'{self.name}_bucket{format_labels(dict(labels, le="+Inf"))} {count}\n')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {total}\n')
+                lines.append(f'{self.name}_count{format_labels(labels)} {count}\n')
+        return ''.join(lines)
+
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', 'Telegram handler latency', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Telegram handler failures', ('handler',))
+ELASTICPATH_LATENCY = Histogram('elasticpath_call_duration_seconds', 'Elastic Path call latency', ('call',))
+ELASTICPATH_ERRORS = Counter('elasticpath_call_errors_total', 'Elastic Path call failures', ('call',))
+ELASTICPATH_RESPONSES = Counter('elasticpath_responses_total', 'Elastic Path responses by HTTP status',
+                                ('method', 'status'))
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups by result', ('cache', 'result'))
+TOKEN_REFRESHES = Counter('elasticpath_token_refreshes_total', 'Elastic Path token refreshes', ('result',))
+DUPLICATE_UPDATES = Counter('bot_duplicate_updates_total', 'Dropped duplicate updates and callback taps', ('kind',))
+RATE_LIMIT_DELAYS = Histogram('ratelimit_delay_seconds', 'Time outbound calls waited for a rate limit', ('limiter',))
+
+
+def timed(histogram, errors, **labels):
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started_at, **labels)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started_at, **labels)
+        return wrapper
+    return decorator
+
+
+def track_handler(function):
+    return timed(HANDLER_LATENCY, HANDLER_ERRORS, handler=function.__name__)(function)
+
+
+def track_call(function):
+    return timed(ELASTICPATH_LATENCY, ELASTICPATH_ERRORS, call=function.__name__)(function)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='sampling-profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed(self):
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename})')
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = REGISTRY.render()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/profile' and self.server.profiler is not None:
+            body = self.server.profiler.collapsed()
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, address='127.0.0.1', profiler=None):
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.profiler = profiler
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+    return server
+
+
+def start_instrumentation(metrics_port=None, metrics_listen='127.0.0.1', profile_interval=None):
+    profiler = None
+    if profile_interval:
+        profiler = SamplingProfiler(float(profile_interval) / 1000)
+        profiler.start()
+    if metrics_port:
+        start_metrics_server(int(metrics_port), metrics_listen, profiler)
+    return profiler
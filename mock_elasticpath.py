@@ -0,0 +1,265 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockStore:
+    def __init__(self, products=20):
+        self.products = {}
+        self.files = {}
+        for number in range(products):
+            product_id = str(uuid.uuid4())
+            file_id = str(uuid.uuid4())
+            self.products[product_id] = {'name': f'Fish {number}',
+                                         'sku': f'FISH-{number:04d}',
+                                         'description': f'Fresh fish number {number}',
+                                         'amount': 1000 + number * 10,
+                                         'file_id': file_id}
+            self.files[file_id] = f'https://files.example.com/{file_id}.jpg'
+        self.carts = {}
+        self.customers = set()
+        self.lock = threading.Lock()
+
+    def price(self, amount):
+        return {'amount': amount, 'currency': 'USD', 'formatted': f'${amount / 100:,.2f}'}
+
+    def currencies(self):
+        return [{'type': 'currency', 'code': 'USD', 'format': '${price}', 'decimal_point': '.',
+                 'thousand_separator': ',', 'decimal_places': 2, 'default': True, 'enabled': True}]
+
+    def pcm_product(self, product_id, include_files=False):
+        product = self.products[product_id]
+        pcm_product = {'id': product_id, 'type': 'product',
+                       'attributes': {'name': product['name'],
+                                      'sku': product['sku'],
+                                      'description': product['description']}}
+        if include_files:
+            pcm_product['relationships'] = {'files': {'data': [{'type': 'file', 'id': product['file_id']}]}}
+        return pcm_product
+
+    def file(self, file_id):
+        return {'type': 'file', 'id': file_id, 'link': {'href': self.files[file_id]}}
+
+    def page(self, query):
+        offset = int(query.get('page[offset]', [0])[0])
+        limit = int(query.get('page[limit]', [25])[0])
+        return list(self.products)[offset:offset + limit], {'page': {'offset': offset, 'limit': limit},
+                                                            'results': {'total': len(self.products)}}
+
+    def catalog_product(self, product_id):
+        product = self.products[product_id]
+        return {'id': product_id, 'type': 'product',
+                'attributes': {'name': product['name'], 'sku': product['sku']},
+                'meta': {'display_price': {'with_tax': self.price(product['amount'])}}}
+
+    def cart(self, cart_id):
+        items = []
+        total = 0
+        for item_id, (product_id, quantity) in self.carts.get(cart_id, {}).items():
+            amount = self.products[product_id]['amount']
+            total += amount * quantity
+            items.append({'id': item_id,
+                          'type': 'cart_item',
+                          'product_id': product_id,
+                          'name': self.products[product_id]['name'],
+                          'quantity': quantity,
+                          'meta': {'display_price': {'with_tax': {'unit': self.price(amount),
+                                                                  'value': self.price(amount * quantity)}}}})
+        return {'data': items, 'meta': {'display_price': {'with_tax': self.price(total)}}}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [('POST', r'/oauth/access_token', 'token'),
+              ('GET', r'/pcm/products', 'products'),
+              ('GET', r'/pcm/products/(?P<product_id>[^/]+)/relationships/files', 'product_files'),
+              ('GET', r'/pcm/products/(?P<product_id>[^/]+)', 'pcm_product'),
+              ('GET', r'/catalog/products', 'catalog_products'),
+              ('GET', r'/catalog/products/(?P<product_id>[^/]+)', 'catalog_product'),
+              ('GET', r'/v2/files/(?P<file_id>[^/]+)', 'file'),
+              ('GET', r'/v2/currencies', 'currencies'),
+              ('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'cart'),
+              ('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'add_to_cart'),
+              ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'clear_cart'),
+              ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', 'remove_from_cart'),
+              ('POST', r'/v2/customers', 'create_customer')]
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def dispatch(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(max(random.gauss(server.latency, server.jitter), 0))
+        if random.random() < server.error_rate:
+            status = random.choice((429, 500, 503))
+            self.reply(status, {'errors': [{'status': status, 'title': 'Injected error'}]},
+                       headers={'Retry-After': '0'} if status == 429 else None)
+            return
+        path = urlparse(self.path).path
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                try:
+                    status, payload = getattr(self, name)(body=body, **match.groupdict())
+                except KeyError:
+                    status, payload = 404, {'errors': [{'status': 404, 'title': 'Not found'}]}
+                self.reply(status, payload)
+                return
+        self.reply(404, {'errors': [{'status': 404, 'title': 'Not found'}]})
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def token(self, body):
+        return 200, {'access_token': uuid.uuid4().hex,
+                     'token_type': 'Bearer',
+                     'expires': int(time.time()) + 3600,
+                     'expires_in': 3600}
+
+    def products(self, body):
+        store = self.server.store
+        query = parse_qs(urlparse(self.path).query)
+        include_files = 'files' in query.get('include', [''])[0].split(',')
+        product_ids, meta = store.page(query)
+        payload = {'data': [store.pcm_product(product_id, include_files) for product_id in product_ids],
+                   'meta': meta}
+        if include_files:
+            payload['included'] = {'files': [store.file(store.products[product_id]['file_id'])
+                                             for product_id in product_ids]}
+        return 200, payload
+
+    def pcm_product(self, body, product_id):
+        store = self.server.store
+        include_files = 'files' in parse_qs(urlparse(self.path).query).get('include', [''])[0].split(',')
+        payload = {'data': store.pcm_product(product_id, include_files)}
+        if include_files:
+            payload['included'] = {'files': [store.file(store.products[product_id]['file_id'])]}
+        return 200, payload
+
+    def catalog_products(self, body):
+        store = self.server.store
+        product_ids, meta = store.page(parse_qs(urlparse(self.path).query))
+        return 200, {'data': [store.catalog_product(product_id) for product_id in product_ids], 'meta': meta}
+
+    def catalog_product(self, body, product_id):
+        return 200, {'data': self.server.store.catalog_product(product_id)}
+
+    def product_files(self, body, product_id):
+        file_id = self.server.store.products[product_id]['file_id']
+        return 200, {'data': [{'type': 'file', 'id': file_id}]}
+
+    def file(self, body, file_id):
+        return 200, {'data': self.server.store.file(file_id)}
+
+    def currencies(self, body):
+        return 200, {'data': self.server.store.currencies()}
+
+    def cart(self, body, cart_id):
+        store = self.server.store
+        with store.lock:
+            return 200, store.cart(cart_id)
+
+    def add_to_cart(self, body, cart_id):
+        store = self.server.store
+        data = json.loads(body)['data']
+        if data['id'] not in store.products:
+            return 404, {'errors': [{'status': 404, 'title': 'Product not found'}]}
+        with store.lock:
+            items = store.carts.setdefault(cart_id, {})
+            for item_id, (product_id, quantity) in items.items():
+                if product_id == data['id']:
+                    items[item_id] = (product_id, quantity + data['quantity'])
+                    break
+            else:
+                items[str(uuid.uuid4())] = (data['id'], data['quantity'])
+            return 201, store.cart(cart_id)
+
+    def clear_cart(self, body, cart_id):
+        store = self.server.store
+        with store.lock:
+            store.carts.pop(cart_id, None)
+            return 200, store.cart(cart_id)
+
+    def remove_from_cart(self, body, cart_id, item_id):
+        store = self.server.store
+        with store.lock:
+            store.carts.get(cart_id, {}).pop(item_id, None)
+            return 200, store.cart(cart_id)
+
+    def create_customer(self, body, **kwargs):
+        store = self.server.store
+        email = json.loads(body)['data']['email']
+        if '@' not in email:
+            return 422, {'errors': [{'status': 422, 'title': 'Invalid email'}]}
+        with store.lock:
+            if email in store.customers:
+                return 409, {'errors': [{'status': 409, 'title': 'Duplicate email'}]}
+            store.customers.add(email)
+        return 201, {'data': {'id': str(uuid.uuid4()), 'type': 'customer', 'email': email}}
+
+
+class MockElasticPathServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), store=None, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__(address, MockRequestHandler)
+        self.store = store or MockStore()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True, name='mock-elasticpath')
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Elastic Path endpoints used by the bot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean latency per request, ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency standard deviation, ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429/5xx')
+    args = parser.parse_args()
+    server = MockElasticPathServer((args.host, args.port), MockStore(args.products),
+                                   latency=args.latency / 1000, jitter=args.jitter / 1000,
+                                   error_rate=args.error_rate)
+    print(f'Mock Elastic Path is listening on {server.url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
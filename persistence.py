@@ -0,0 +1,200 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+_DELETED = object()
+
+
+class StateBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set_many(self, items):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    def __init__(self, path='bot_state.sqlite3'):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS state ('
+                                     'key TEXT PRIMARY KEY, '
+                                     'value TEXT NOT NULL)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_many(self, items):
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                                         items.items())
+
+    def delete_many(self, keys):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM state WHERE key = ?', [(key,) for key in keys])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class KeyValueBackend(StateBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set_many(self, items):
+        self.client.mset(items)
+
+    def delete_many(self, keys):
+        self.client.delete(*keys)
+
+
+class MemoryKeyValueStore:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def mset(self, mapping):
+        with self._lock:
+            self._values.update(mapping)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+
+def create_backend(name, path='bot_state.sqlite3', redis_url=None):
+    if name == 'sqlite':
+        return SQLiteBackend(path)
+    if name == 'redis':
+        import redis
+        return KeyValueBackend(redis.Redis.from_url(redis_url))
+    if name == 'memory':
+        return KeyValueBackend(MemoryKeyValueStore())
+    raise ValueError(f'Unknown state backend: {name}')
+
+
+class PersistentDict(MutableMapping):
+    def __init__(self, backend, namespace, encode=lambda value: value, decode=lambda value: value,
+                 flush_interval=0.05, cache_size=100000):
+        self.backend = backend
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'persistence-{namespace}')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _key(self, key):
+        return f'{self.namespace}:{json.dumps(key)}'
+
+    def __getitem__(self, key):
+        storage_key = self._key(key)
+        with self._lock:
+            if storage_key in self._cache:
+                self._cache.move_to_end(storage_key)
+                value = self._cache[storage_key]
+            else:
+                raw_value = self._pending.get(storage_key, self._flushing.get(storage_key))
+                value = None if raw_value is None else self._load(storage_key, raw_value)
+        if value is None:
+            raw_value = self.backend.get(storage_key)
+            with self._lock:
+                value = self._cache.get(storage_key)
+                if value is None:
+                    value = self._load(storage_key, raw_value if raw_value is not None else _DELETED)
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        storage_key = self._key(key)
+        with self._lock:
+            self._pending[storage_key] = json.dumps(self.encode(value))
+            self._remember(storage_key, value)
+
+    def __delitem__(self, key):
+        storage_key = self._key(key)
+        with self._lock:
+            self._pending[storage_key] = _DELETED
+            self._remember(storage_key, _DELETED)
+
+    def _load(self, storage_key, raw_value):
+        value = _DELETED if raw_value is _DELETED else self.decode(json.loads(raw_value))
+        self._remember(storage_key, value)
+        return value
+
+    def _remember(self, storage_key, value):
+        self._cache[storage_key] = value
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __iter__(self):
+        raise TypeError('PersistentDict does not support iteration')
+
+    def __len__(self):
+        raise TypeError('PersistentDict does not support len()')
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = self._flushing = self._pending
+                self._pending = {}
+            if not pending:
+                return
+            deleted = [key for key, value in pending.items() if value is _DELETED]
+            updated = {key: value for key, value in pending.items() if value is not _DELETED}
+            try:
+                if updated:
+                    self.backend.set_many(updated)
+                if deleted:
+                    self.backend.delete_many(deleted)
+            except Exception:
+                logger.exception('Could not persist %s state, will retry', self.namespace)
+                with self._lock:
+                    self._pending = dict(pending, **self._pending)
+            with self._lock:
+                self._flushing = {}
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,38 @@
+import sqlite3
+import threading
+
+
+class PhotoCache:
+    def __init__(self, path='photo_cache.sqlite3'):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS photos ('
+                                     'product_id TEXT PRIMARY KEY, '
+                                     'source_id TEXT NOT NULL, '
+                                     'file_id TEXT NOT NULL)')
+
+    def get(self, product_id):
+        with self._lock:
+            row = self._connection.execute('SELECT source_id, file_id FROM photos WHERE product_id = ?',
+                                           (product_id,)).fetchone()
+        return row
+
+    def set(self, product_id, source_id, file_id):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO photos (product_id, source_id, file_id) '
+                                     'VALUES (?, ?, ?)',
+                                     (product_id, source_id, file_id))
+
+    def delete(self, product_id):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM photos WHERE product_id = ?', (product_id,))
+
+    def discard_stale(self, source_ids):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM photos WHERE product_id = ? AND source_id != ?',
+                                         source_ids.items())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from metrics import RATE_LIMIT_DELAYS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.burst = burst
+        self._next_at = 0.0
+
+    def tokens(self, now):
+        return self.burst - max(self._next_at - now, 0) / self.interval
+
+    def available_at(self, now):
+        return max(self._next_at - (self.burst - 1) * self.interval, now)
+
+    def take(self, at):
+        self._next_at = max(self._next_at, at) + self.interval
+
+    def pause_until(self, until):
+        self._next_at = max(self._next_at, until + (self.burst - 1) * self.interval)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1, per_key_rate=None, per_key_burst=1, reserve=0, max_keys=10000,
+                 name='ratelimit'):
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self.reserve = reserve
+        self.max_keys = max_keys
+        self.name = name
+        self._bucket = TokenBucket(rate, burst)
+        self._key_buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key=None, low_priority=False):
+        with self._lock:
+            now = time.monotonic()
+            if low_priority and self._bucket.tokens(now) < self.reserve + 1:
+                return None
+            buckets = [self._bucket]
+            if key is not None and self.per_key_rate:
+                buckets.append(self._key_bucket(key))
+            at = max(bucket.available_at(now) for bucket in buckets)
+            for bucket in buckets:
+                bucket.take(at)
+        delay = at - now
+        if delay > 0:
+            RATE_LIMIT_DELAYS.observe(delay, limiter=self.name)
+        return delay
+
+    def ready_at(self, key=None):
+        with self._lock:
+            now = time.monotonic()
+            at = self._bucket.available_at(now)
+            if key is not None and self.per_key_rate:
+                at = max(at, self._key_bucket(key).available_at(now))
+        return at
+
+    def wait(self, key=None):
+        time.sleep(self.acquire(key))
+
+    def pause(self, seconds, key=None):
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._bucket.pause_until(until)
+            if key is not None and self.per_key_rate:
+                self._key_bucket(key).pause_until(until)
+
+    def _key_bucket(self, key):
+        bucket = self._key_buckets.get(key)
+        if bucket is None:
+            bucket = self._key_buckets[key] = TokenBucket(self.per_key_rate, self.per_key_burst)
+            while len(self._key_buckets) > self.max_keys:
+                self._key_buckets.popitem(last=False)
+        self._key_buckets.move_to_end(key)
+        return bucket
+
+
+def create_telegram_limiter():
+    return RateLimiter(float(os.getenv('TG_RATE_LIMIT', 30)),
+                       burst=int(os.getenv('TG_BURST', 30)),
+                       per_key_rate=float(os.getenv('TG_CHAT_RATE_LIMIT', 1)),
+                       per_key_burst=int(os.getenv('TG_CHAT_BURST', 3)),
+                       reserve=int(os.getenv('TG_REPLY_RESERVE', 10)),
+                       name='telegram')
+
+
+class OutboxMessage:
+    __slots__ = ('limit_key', 'future', 'fn', 'args', 'kwargs', 'attempt')
+
+    def __init__(self, limit_key, fn, args, kwargs):
+        self.limit_key = limit_key
+        self.future = Future()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.attempt = 0
+
+
+class Outbox:
+    def __init__(self, limiter, workers=4, retries=3, get_retry_after=None, name='outbox'):
+        self.limiter = limiter
+        self.retries = retries
+        self.get_retry_after = get_retry_after or (lambda error: getattr(error, 'retry_after', None))
+        self._queues = {}
+        self._ready = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f'{name}-{number}')
+                         for number in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, key, fn, *args, **kwargs):
+        return self._submit(key, OutboxMessage(key, fn, args, kwargs))
+
+    def submit_unordered(self, fn, *args, **kwargs):
+        return self._submit(('unordered', next(self._counter)), OutboxMessage(None, fn, args, kwargs))
+
+    def _submit(self, key, message):
+        with self._condition:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._schedule(key, time.monotonic())
+            queue.append(message)
+        return message.future
+
+    def _schedule(self, key, at):
+        heapq.heappush(self._ready, (at, next(self._counter), key))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                entry = self._next_entry()
+            if entry is None:
+                return
+            key, message = entry
+            if message.attempt == 0 and not message.future.set_running_or_notify_cancel():
+                self._done(key)
+                continue
+            self._send(key, message)
+
+    def _next_entry(self):
+        while True:
+            now = time.monotonic()
+            if self._ready and self._ready[0][0] <= now:
+                _, _, key = heapq.heappop(self._ready)
+                message = self._queues[key][0]
+                ready_at = self.limiter.ready_at(message.limit_key)
+                if ready_at <= time.monotonic():
+                    return key, message
+                heapq.heappush(self._ready, (ready_at, next(self._counter), key))
+                continue
+            if self._stopped and not self._queues:
+                return None
+            self._condition.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _send(self, key, message):
+        time.sleep(self.limiter.acquire(message.limit_key))
+        try:
+            result = message.fn(*message.args, **message.kwargs)
+        except Exception as error:
+            retry_after = self.get_retry_after(error)
+            if retry_after is not None and message.attempt < self.retries:
+                message.attempt += 1
+                logger.warning('Flood control for %s, retrying in %s seconds', message.limit_key, retry_after)
+                self.limiter.pause(retry_after, message.limit_key)
+                self._done(key, sent=False)
+                return
+            logger.error('Could not send a message to %s: %s', message.limit_key, error)
+            self._done(key)
+            message.future.set_exception(error)
+            return
+        self._done(key)
+        message.future.set_result(result)
+
+    def _done(self, key, sent=True):
+        with self._condition:
+            queue = self._queues[key]
+            if sent:
+                queue.popleft()
+            if queue:
+                self._schedule(key, self.limiter.ready_at(queue[0].limit_key))
+            else:
+                del self._queues[key]
+            self._condition.notify_all()
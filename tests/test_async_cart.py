@@ -0,0 +1,82 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import async_cart
+from async_cart import AsyncCartStore
+from tests.test_cart import PRODUCT_INFO, FakeElasticPath
+
+
+class AsyncFakeElasticPath(FakeElasticPath):
+    async def get_cart_items(self, client, cart_id):
+        return FakeElasticPath.get_cart_items(self, client, cart_id)
+
+    async def add_product_to_cart(self, client, cart_id, product_id, quantity):
+        FakeElasticPath.add_product_to_cart(self, client, cart_id, product_id, quantity)
+
+    async def delete_product_from_cart(self, client, cart_id, item_id):
+        FakeElasticPath.delete_product_from_cart(self, client, cart_id, item_id)
+
+    async def remove_all_from_cart(self, client, cart_id):
+        FakeElasticPath.remove_all_from_cart(self, client, cart_id)
+
+    async def get_currencies(self, client):
+        return FakeElasticPath.get_currencies(self, client)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = AsyncFakeElasticPath()
+    for name in ('get_cart_items', 'add_product_to_cart', 'delete_product_from_cart', 'remove_all_from_cart',
+                 'get_currencies'):
+        monkeypatch.setattr(async_cart, name, getattr(upstream, name))
+    return upstream
+
+
+def run_with_store(scenario):
+    async def run():
+        store = AsyncCartStore(None, flush_delay=60, maxsize=2, ttl=60)
+        store.start()
+        try:
+            await scenario(store)
+        finally:
+            await store.stop()
+    asyncio.run(run())
+
+
+async def quantities(store, user_id):
+    products, _ = await store.get_items(user_id)
+    return {product['id']: product['qty'] for product in products}
+
+
+def test_flush_coalesces_adds(upstream):
+    async def scenario(store):
+        await store.add('u', 'a', PRODUCT_INFO, 1)
+        await store.add('u', 'a', PRODUCT_INFO, 3)
+        await store._flush_dirty()
+        assert upstream.writes() == [('add', 'u', 'a', 4)]
+        assert await quantities(store, 'u') == {'a': 4}
+    run_with_store(scenario)
+
+
+def test_failed_flush_requeues_remaining_operations(upstream):
+    async def scenario(store):
+        upstream.carts['u'] = {'a': ('item-a', 1)}
+        await store.remove_all('u')
+        await store.add('u', 'b', PRODUCT_INFO, 1)
+        upstream.failures['add'] = aiohttp.ClientConnectionError()
+        await store._flush_dirty()
+        assert store._carts['u'].pending.adds == {'b': 1}
+        assert not store._carts['u'].pending.clear
+        await store._flush_dirty()
+        assert upstream.writes() == [('clear', 'u'), ('add', 'u', 'b', 1), ('add', 'u', 'b', 1)]
+        assert await quantities(store, 'u') == {'b': 1}
+    run_with_store(scenario)
+
+
+def test_stop_flushes_pending_changes(upstream):
+    async def scenario(store):
+        await store.add('u', 'a', PRODUCT_INFO, 2)
+    run_with_store(scenario)
+    assert upstream.writes() == [('add', 'u', 'a', 2)]
@@ -0,0 +1,229 @@
+import uuid
+
+import pytest
+import requests
+
+import cart
+from cart import CartOperations, CartStore, format_price, get_currency_format
+
+
+PRODUCT_INFO = {'product_name': 'Fish', 'product_amount': 1050, 'product_currency': 'USD'}
+
+
+class FakeElasticPath:
+    def __init__(self):
+        self.carts = {}
+        self.calls = []
+        self.failures = {}
+
+    def _call(self, name, *args):
+        self.calls.append((name,) + args)
+        error = self.failures.pop(name, None)
+        if error is not None:
+            raise error
+
+    def get_cart_items(self, client, cart_id):
+        self._call('get', cart_id)
+        items = [{'id': item_id, 'product_id': product_id, 'name': product_id, 'qty': quantity,
+                  'price': '$10.50', 'amount': 1050, 'currency': 'USD', 'subtotal': ''}
+                 for product_id, (item_id, quantity) in self.carts.get(cart_id, {}).items()]
+        return items, ''
+
+    def add_product_to_cart(self, client, cart_id, product_id, quantity):
+        self._call('add', cart_id, product_id, quantity)
+        items = self.carts.setdefault(cart_id, {})
+        item_id, current = items.get(product_id, (str(uuid.uuid4()), 0))
+        items[product_id] = (item_id, current + quantity)
+
+    def delete_product_from_cart(self, client, cart_id, item_id):
+        self._call('delete', cart_id, item_id)
+        items = self.carts.get(cart_id, {})
+        for product_id, (current_id, _) in list(items.items()):
+            if current_id == item_id:
+                del items[product_id]
+
+    def remove_all_from_cart(self, client, cart_id):
+        self._call('clear', cart_id)
+        self.carts.pop(cart_id, None)
+
+    def get_currencies(self, client):
+        return {'USD': {'format': '${price}', 'decimal_point': '.', 'thousand_separator': ',',
+                        'decimal_places': 2, 'default': True}}
+
+    def writes(self):
+        return [call for call in self.calls if call[0] != 'get']
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = FakeElasticPath()
+    for name in ('get_cart_items', 'add_product_to_cart', 'delete_product_from_cart', 'remove_all_from_cart',
+                 'get_currencies'):
+        monkeypatch.setattr(cart, name, getattr(upstream, name))
+    return upstream
+
+
+@pytest.fixture
+def store(upstream):
+    store = CartStore(None, flush_delay=60, maxsize=2, ttl=60)
+    store.start()
+    yield store
+    store.stop()
+
+
+def quantities(store, user_id):
+    products, _ = store.get_items(user_id)
+    return {product['id']: product['qty'] for product in products}
+
+
+def test_merge_sums_adds():
+    older = CartOperations()
+    older.add('a', 1)
+    newer = CartOperations()
+    newer.add('a', 2)
+    newer.add('b', 1)
+    merged = older.merge(newer)
+    assert merged.adds == {'a': 3, 'b': 1}
+    assert not merged.clear and not merged.removes
+
+
+def test_merge_remove_drops_older_add():
+    older = CartOperations()
+    older.add('a', 1)
+    older.add('b', 1)
+    newer = CartOperations()
+    newer.remove('a')
+    merged = older.merge(newer)
+    assert merged.adds == {'b': 1}
+    assert merged.removes == {'a'}
+
+
+def test_merge_newer_clear_wins():
+    older = CartOperations()
+    older.add('a', 1)
+    older.remove('b')
+    newer = CartOperations()
+    newer.remove_all()
+    newer.add('c', 2)
+    merged = older.merge(newer)
+    assert merged.clear
+    assert merged.adds == {'c': 2}
+    assert not merged.removes
+
+
+def test_merge_keeps_older_clear():
+    older = CartOperations()
+    older.remove_all()
+    newer = CartOperations()
+    newer.add('a', 1)
+    merged = older.merge(newer)
+    assert merged.clear
+    assert merged.adds == {'a': 1}
+
+
+def test_flush_coalesces_adds(store, upstream):
+    store.add('u', 'a', PRODUCT_INFO, 1)
+    store.add('u', 'a', PRODUCT_INFO, 3)
+    store._flush_dirty()
+    assert upstream.writes() == [('add', 'u', 'a', 4)]
+    assert quantities(store, 'u') == {'a': 4}
+
+
+def test_flush_applies_clear_before_adds(store, upstream):
+    upstream.carts['u'] = {'a': ('item-a', 2)}
+    store.remove_all('u')
+    store.add('u', 'b', PRODUCT_INFO, 1)
+    store._flush_dirty()
+    assert upstream.writes() == [('clear', 'u'), ('add', 'u', 'b', 1)]
+    assert quantities(store, 'u') == {'b': 1}
+
+
+def test_remove_looks_up_item_ids_added_since_the_last_read(store, upstream):
+    store.add('u', 'a', PRODUCT_INFO, 1)
+    store._flush_dirty()
+    upstream.carts['u']['a'] = ('item-a', 1)
+    store._carts['u'].items['a']['item_id'] = None
+    store.remove('u', 'a')
+    store._flush_dirty()
+    assert upstream.writes()[-1] == ('delete', 'u', 'item-a')
+    assert quantities(store, 'u') == {}
+
+
+def test_failed_flush_requeues_remaining_operations(store, upstream):
+    upstream.carts['u'] = {'a': ('item-a', 1)}
+    store.remove_all('u')
+    store.add('u', 'b', PRODUCT_INFO, 1)
+    upstream.failures['add'] = requests.ConnectionError()
+    store._flush_dirty()
+    assert store._carts['u'].pending.adds == {'b': 1}
+    assert not store._carts['u'].pending.clear
+    store.add('u', 'b', PRODUCT_INFO, 2)
+    store._flush_dirty()
+    assert upstream.writes() == [('clear', 'u'), ('add', 'u', 'b', 1), ('add', 'u', 'b', 3)]
+    assert upstream.carts['u']['b'][1] == 3
+    assert quantities(store, 'u') == {'b': 3}
+
+
+def test_failed_flush_keeps_newer_clear(store, upstream):
+    store.add('u', 'a', PRODUCT_INFO, 1)
+    upstream.failures['add'] = requests.ConnectionError()
+    store._flush_dirty()
+    store.remove_all('u')
+    store._flush_dirty()
+    assert upstream.writes() == [('add', 'u', 'a', 1), ('clear', 'u')]
+    assert quantities(store, 'u') == {}
+
+
+def test_rejected_flush_reloads_the_cart(store, upstream):
+    upstream.carts['u'] = {'a': ('item-a', 2)}
+    store.add('u', 'b', PRODUCT_INFO, 1)
+    upstream.failures['add'] = requests.HTTPError()
+    store._flush_dirty()
+    assert not store._carts['u'].pending
+    assert quantities(store, 'u') == {'a': 2}
+
+
+def test_evicts_least_recently_used_idle_cart(store, upstream):
+    store.add('a', 'p', PRODUCT_INFO, 1)
+    store.get_items('b')
+    store.get_items('c')
+    assert list(store._carts) == ['a', 'c']
+    store._flush_dirty()
+    store.get_items('d')
+    assert list(store._carts) == ['c', 'd']
+
+
+def test_reloads_idle_cart_after_ttl(store, upstream):
+    store.get_items('u')
+    upstream.carts['u'] = {'a': ('item-a', 5)}
+    assert quantities(store, 'u') == {}
+    store._carts['u'].loaded_at -= store.ttl
+    assert quantities(store, 'u') == {'a': 5}
+
+
+def test_does_not_reload_cart_with_pending_changes(store, upstream):
+    store.add('u', 'a', PRODUCT_INFO, 1)
+    upstream.carts['u'] = {'b': ('item-b', 5)}
+    store._carts['u'].loaded_at -= store.ttl
+    assert quantities(store, 'u') == {'a': 1}
+
+
+def test_cart_uses_one_price_format(store, upstream):
+    store.add('u', 'a', PRODUCT_INFO, 300)
+    products, total = store.get_items('u')
+    assert products[0]['price'] == '$10.50'
+    assert products[0]['subtotal'] == '$3,150.00'
+    assert total == '$3,150.00'
+
+
+def test_empty_cart_total_uses_default_currency(store, upstream):
+    assert store.get_items('u') == ([], '$0.00')
+    assert format_price(0, get_currency_format({}, '')) == '0.00'
+
+
+def test_format_price_uses_currency_decimals_and_separators():
+    euro = {'format': '{price} €', 'decimal_point': ',', 'thousand_separator': '.', 'decimal_places': 2}
+    yen = {'format': '¥{price}', 'decimal_point': '.', 'thousand_separator': ',', 'decimal_places': 0}
+    assert format_price(123456, euro) == '1.234,56 €'
+    assert format_price(123456, yen) == '¥123,456'
+    assert format_price(4000, get_currency_format({}, 'USD')) == '40.00 USD'
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import async_tgbot
+import checkout
+from async_tgbot import AsyncCheckoutPipeline
+from checkout import CREATED, EXISTS, FAILED, FOLLOW_UPS, CheckoutPipeline
+
+
+class FakeElasticPath:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.calls = []
+        self.statuses = []
+
+    def create_customer(self, client, name, email, password):
+        self.calls.append(email)
+        return self.statuses.pop(0) if self.statuses else 201
+
+    async def create_customer_async(self, client, name, email, password):
+        return self.create_customer(client, name, email, password)
+
+
+class FlakyCustomers(dict):
+    def __init__(self, failures=1):
+        super().__init__()
+        self.failures = failures
+
+    def get(self, email, default=None):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('state storage is down')
+        return super().get(email, default)
+
+
+def follow_up(result, email):
+    return FOLLOW_UPS[result].format(email=email)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = FakeElasticPath()
+    monkeypatch.setattr(checkout, 'create_customer', upstream.create_customer)
+    monkeypatch.setattr(async_tgbot, 'create_customer', upstream.create_customer_async)
+    yield upstream
+    upstream.executor.shutdown()
+
+
+def run_sync(upstream, submit, customers=None, expected=1, **kwargs):
+    messages = []
+    done = threading.Event()
+
+    def notify(chat_id, text):
+        messages.append((chat_id, text))
+        if len(messages) >= expected:
+            done.set()
+
+    pipeline = CheckoutPipeline(upstream, notify, customers=customers, batch_delay=0.05, retry_delay=0.01,
+                                **kwargs)
+    submit(pipeline)
+    pipeline.start()
+    assert done.wait(5)
+    pipeline.stop()
+    return messages
+
+
+def run_async(upstream, submit, customers=None, expected=1, **kwargs):
+    messages = []
+
+    async def notify(chat_id, text):
+        messages.append((chat_id, text))
+
+    async def run():
+        pipeline = AsyncCheckoutPipeline(upstream, notify, customers=customers, batch_delay=0.05,
+                                         retry_delay=0.01, **kwargs)
+        pipeline.start()
+        submit(pipeline)
+        for _ in range(500):
+            if len(messages) >= expected:
+                break
+            await asyncio.sleep(0.01)
+        await pipeline.stop()
+
+    asyncio.run(run())
+    return messages
+
+
+@pytest.fixture(params=[run_sync, run_async], ids=['threaded', 'asyncio'])
+def run_pipeline(request, upstream):
+    return lambda *args, **kwargs: request.param(upstream, *args, **kwargs)
+
+
+def test_duplicate_emails_in_a_batch_make_one_request(run_pipeline, upstream):
+    def submit(pipeline):
+        pipeline.submit(1, 'Ann', 'ann@example.com', 'p')
+        pipeline.submit(2, 'Ann', ' ANN@example.com', 'p')
+
+    messages = run_pipeline(submit, expected=2)
+    assert upstream.calls == ['ann@example.com']
+    assert sorted(messages) == [(1, follow_up(CREATED, 'ann@example.com')),
+                                (2, follow_up(CREATED, 'ann@example.com'))]
+
+
+def test_known_customer_is_answered_without_a_request(run_pipeline, upstream):
+    def submit(pipeline):
+        pipeline.submit(1, 'Ann', 'ann@example.com', 'p')
+
+    messages = run_pipeline(submit, customers={'ann@example.com': CREATED})
+    assert upstream.calls == []
+    assert messages == [(1, follow_up(EXISTS, 'ann@example.com'))]
+
+
+def test_server_errors_are_retried_then_reported(run_pipeline, upstream):
+    upstream.statuses = [500, 503, 500]
+
+    def submit(pipeline):
+        pipeline.submit(1, 'Ann', 'ann@example.com', 'p')
+
+    customers = {}
+    messages = run_pipeline(submit, customers=customers, retries=2)
+    assert upstream.calls == ['ann@example.com'] * 3
+    assert messages == [(1, follow_up(FAILED, 'ann@example.com'))]
+    assert customers == {}
+
+
+def test_failed_batch_does_not_stop_the_worker(run_pipeline, upstream):
+    def submit(pipeline):
+        pipeline.submit(1, 'Ann', 'ann@example.com', 'p')
+        pipeline.submit(2, 'Bob', 'bob@example.com', 'p')
+
+    messages = run_pipeline(submit, customers=FlakyCustomers(), batch_size=1)
+    assert upstream.calls == ['bob@example.com']
+    assert messages == [(2, follow_up(CREATED, 'bob@example.com'))]
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from ratelimit import Outbox, RateLimiter, TokenBucket
+
+
+class FloodError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'retry after {retry_after}')
+        self.retry_after = retry_after
+
+
+class Recorder:
+    def __init__(self, duration=0.0):
+        self.duration = duration
+        self.calls = []
+        self.active = {}
+        self.peak = {}
+        self._lock = threading.Lock()
+
+    def send(self, key, value):
+        with self._lock:
+            self.active[key] = self.active.get(key, 0) + 1
+            self.peak[key] = max(self.peak.get(key, 0), self.active[key])
+        time.sleep(self.duration)
+        with self._lock:
+            self.active[key] -= 1
+            self.calls.append((key, value))
+        return value
+
+
+@pytest.fixture
+def outbox():
+    outbox = Outbox(RateLimiter(1000, burst=1000, per_key_rate=1000, per_key_burst=1000), workers=4, retries=2)
+    outbox.start()
+    yield outbox
+    outbox.stop()
+
+
+def test_bucket_allows_a_burst_then_one_token_per_interval():
+    bucket = TokenBucket(rate=2, burst=3)
+    assert bucket.tokens(10.0) == 3
+    for _ in range(3):
+        bucket.take(bucket.available_at(10.0))
+    assert bucket.tokens(10.0) == 0
+    assert bucket.available_at(10.0) == 10.5
+    bucket.take(bucket.available_at(10.0))
+    assert bucket.available_at(10.0) == 11.0
+    assert bucket.tokens(12.5) == 3
+
+
+def test_bucket_pause_keeps_the_burst_after_the_pause():
+    bucket = TokenBucket(rate=1, burst=3)
+    bucket.pause_until(5.0)
+    assert bucket.available_at(0.0) == 5.0
+    assert bucket.tokens(5.0) == 1
+    assert bucket.tokens(7.0) == 3
+
+
+def test_limiter_applies_the_per_key_rate():
+    limiter = RateLimiter(100, burst=100, per_key_rate=1, per_key_burst=1)
+    assert limiter.acquire('a') == 0
+    assert limiter.ready_at('a') - time.monotonic() == pytest.approx(1, abs=0.05)
+    assert limiter.ready_at('b') <= time.monotonic()
+    assert limiter.acquire('b') == 0
+    assert limiter.acquire('a') == pytest.approx(1, abs=0.05)
+
+
+def test_low_priority_calls_leave_the_reserve_to_replies():
+    limiter = RateLimiter(0.01, burst=3, reserve=2)
+    assert limiter.acquire(low_priority=True) == 0
+    assert limiter.acquire(low_priority=True) is None
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+
+
+def test_flood_control_requeues_the_message_in_order(outbox):
+    recorder = Recorder()
+    failures = [FloodError(0.1)]
+
+    def send(key, value):
+        if failures:
+            raise failures.pop()
+        return recorder.send(key, value)
+
+    started = time.monotonic()
+    first = outbox.submit(1, send, 1, 'first')
+    second = outbox.submit(1, send, 1, 'second')
+    assert first.result(timeout=5) == 'first'
+    assert second.result(timeout=5) == 'second'
+    assert time.monotonic() - started >= 0.1
+    assert recorder.calls == [(1, 'first'), (1, 'second')]
+
+
+def test_flood_control_gives_up_after_the_retries(outbox):
+    def send():
+        raise FloodError(0)
+
+    with pytest.raises(FloodError):
+        outbox.submit(1, send).result(timeout=5)
+
+
+def test_messages_of_one_key_are_sent_one_at_a_time(outbox):
+    recorder = Recorder(duration=0.02)
+    futures = [outbox.submit(key, recorder.send, key, value) for value in range(5) for key in (None, 1)]
+    for future in futures:
+        future.result(timeout=5)
+    assert [value for key, value in recorder.calls if key is None] == list(range(5))
+    assert [value for key, value in recorder.calls if key == 1] == list(range(5))
+    assert recorder.peak == {None: 1, 1: 1}
+
+
+def test_unordered_messages_are_sent_in_parallel(outbox):
+    recorder = Recorder(duration=0.1)
+    started = time.monotonic()
+    futures = [outbox.submit_unordered(recorder.send, 'answer', value) for value in range(8)]
+    for future in futures:
+        future.result(timeout=5)
+    assert time.monotonic() - started < 0.6
+    assert recorder.peak['answer'] == 4
@@ -1,102 +1,230 @@
 import os
 import logging
-from enum import Enum, auto
+import threading
+import time
+from collections import OrderedDict
 from functools import partial
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Updater, Filters
+from telegram.utils.request import Request
 from telegram.ext import (CallbackQueryHandler,
                           CommandHandler,
-                          ConversationHandler,
-                          MessageHandler)
-from elasticpath import (get_all_products,
-                         update_elastic_token,
-                         get_product_info_by_id,
-                         get_photo_by_productid,
-                         add_product_to_cart,
-                         get_cart_items,
-                         remove_all_from_cart,
-                         delete_product_from_cart,
-                         create_customer,
-                         check_elastic_token)
+                          DispatcherHandlerStop,
+                          MessageHandler,
+                          TypeHandler)
+from elasticpath import (ElasticPathClient,
+                         CatalogCache,
+                         ProductCache,
+                         get_product_card,
+                         load_catalog)
+from cart import CartStore
+from checkout import CheckoutPipeline, is_valid_email
+from conversation import State
+from dedup import UpdateDeduplicator
+from metrics import CACHE_REQUESTS, start_instrumentation, track_handler
+from persistence import PersistentDict, create_backend
+from photo_cache import PhotoCache
+from ratelimit import Outbox, create_telegram_limiter
+from webhook import ThreadSafeConversationHandler, UpdateWorkerPool, WebhookServer
 
 logger = logging.getLogger(__name__)
 
 
-class State(Enum):
-    START = auto()
-    HANDLE_MENU = auto()
-    HANDLE_DESCRIPTION = auto()
-    HANDLE_CART = auto()
-    WAITING_EMAIL = auto()
-
-
-def handle_menu(bot, update, store_id, client_id, client_secret):
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
-    products = get_all_products(elastic_token, store_id)
-    keyboard = []
-    for product in products:
-        product_name = product['attributes']['name']
-        product_id = product['id']
-        keyboard.append([InlineKeyboardButton(product_name, callback_data=product_id)])
+class RateLimitedBot(Bot):
+    def __init__(self, token, limiter, retries=3, idle_delay=0.05, senders=4, **kwargs):
+        super().__init__(token, **kwargs)
+        self.limiter = limiter
+        self.idle_delay = idle_delay
+        self.outbox = Outbox(limiter, workers=senders, retries=retries,
+                             get_retry_after=lambda error: error.retry_after if isinstance(error, RetryAfter) else None,
+                             name='telegram-outbox')
+        self._deletes = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='telegram-deletes')
+
+    def start(self):
+        self.outbox.start()
+        self._thread.start()
+
+    def stop(self):
+        self.outbox.stop()
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self.outbox.submit_unordered(super().answer_callback_query, *args, **kwargs)
+
+    def delete_message(self, chat_id, message_id, *args, **kwargs):
+        with self._lock:
+            self._deletes[(chat_id, message_id)] = None
+        self._wakeup.set()
+        return True
+
+    sendMessage = send_message
+    sendPhoto = send_photo
+    answerCallbackQuery = answer_callback_query
+    deleteMessage = delete_message
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait()
+            self._delete_pending(low_priority=True)
+        self._delete_pending(low_priority=False)
+
+    def _delete_pending(self, low_priority):
+        while True:
+            with self._lock:
+                if not self._deletes:
+                    self._wakeup.clear()
+                    return
+                chat_id, message_id = next(iter(self._deletes))
+            delay = self.limiter.acquire(low_priority=low_priority and not self._stopped.is_set())
+            if delay is None:
+                time.sleep(self.idle_delay)
+                continue
+            time.sleep(delay)
+            try:
+                super().delete_message(chat_id, message_id)
+            except RetryAfter as error:
+                self.limiter.pause(error.retry_after)
+                continue
+            except TelegramError as error:
+                logger.debug('Could not delete message %s in chat %s: %s', message_id, chat_id, error)
+            with self._lock:
+                self._deletes.pop((chat_id, message_id), None)
+
+
+def build_products_keyboard(records):
+    return [[InlineKeyboardButton(record.name, callback_data=record.id)] for record in records]
+
+
+@track_handler
+def handle_menu(bot, update, menu_cache, page_size):
+    catalog = menu_cache.get()
+    pages = catalog.pages(page_size)
+    page = 0
+    if update.callback_query and update.callback_query.data.startswith('menu_page'):
+        page = min(max(int(update.callback_query.data.split(' ')[1]), 0), pages - 1)
+    keyboard = build_products_keyboard(catalog.page(page, page_size))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton('< Prev', callback_data=f'menu_page {page - 1}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton('Next >', callback_data=f'menu_page {page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
     update.effective_message.delete()
-    update.effective_message.reply_text(text="Let's choose:", reply_markup=InlineKeyboardMarkup(keyboard))
+    update.effective_message.reply_text(text=f"Let's choose (page {page + 1}/{pages}). "
+                                             f"Send a name or SKU to search:",
+                                        reply_markup=InlineKeyboardMarkup(keyboard))
     return State.HANDLE_DESCRIPTION
 
 
-def handle_description(bot, update, store_id, client_id, client_secret):
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
+@track_handler
+def handle_search(bot, update, menu_cache, page_size):
+    records = menu_cache.get().search(update.effective_message.text, page_size)
+    keyboard = build_products_keyboard(records)
+    keyboard.append([InlineKeyboardButton('Menu', callback_data='menu_page 0')])
+    text = 'Found:' if records else 'Nothing found. Try another name or SKU'
+    update.effective_message.reply_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return State.HANDLE_DESCRIPTION
+
+
+def prefetch_catalog(elastic_client, product_cache, photo_cache, page_size=100):
+    catalog, product_cards = load_catalog(elastic_client, page_size)
+    photo_cache.discard_stale({product_id: product_card['photo_id']
+                               for product_id, product_card in product_cards.items()})
+    product_cache.set_many(product_cards)
+    return catalog
+
+
+def load_product_card(product_id, elastic_client, photo_cache):
+    product_card = get_product_card(elastic_client, product_id)
+    photo_cache.discard_stale({product_id: product_card['photo_id']})
+    return product_card
+
+
+@track_handler
+def handle_description(bot, update, product_cache, photo_cache):
     product_id = update.callback_query.data
-    product_info = get_product_info_by_id(elastic_token, product_id, store_id)
+    product_info = product_cache.get(product_id)
+    cached_photo = photo_cache.get(product_id)
+    if cached_photo and cached_photo[0] == product_info['photo_id']:
+        CACHE_REQUESTS.inc(cache='photo', result='hit')
+        photo = cached_photo[1]
+    else:
+        CACHE_REQUESTS.inc(cache='photo', result='miss')
+        photo = product_info['photo_link']
     product_name = product_info['product_name']
     product_description = product_info['product_description']
     product_price = product_info['product_price']
     product_sku = product_info['product_sku']
-    photo_link = get_photo_by_productid(elastic_token, product_id, store_id)
     keyboard = [[InlineKeyboardButton('Buy 1kg', callback_data=f'add_to_cart {product_id} 1'),
                  InlineKeyboardButton('Buy 3kg', callback_data=f'add_to_cart {product_id} 3'),
                  InlineKeyboardButton('Buy 10kg', callback_data=f'add_to_cart {product_id} 10')],
                 [InlineKeyboardButton('Go to cart', callback_data='cart_info')],
                 [InlineKeyboardButton('Back', callback_data='back')]]
-    bot.send_photo(chat_id=update.callback_query.message.chat_id,
-                   caption=f'{product_name}\n'
-                           f'{product_description}\n'
-                           f'{product_price}\n'
-                           f'{product_sku}',
-                   photo=photo_link,
-                   reply_markup=InlineKeyboardMarkup(keyboard))
+    send_photo = partial(bot.send_photo,
+                         chat_id=update.callback_query.message.chat_id,
+                         caption=f'{product_name}\n'
+                                 f'{product_description}\n'
+                                 f'{product_price}\n'
+                                 f'{product_sku}',
+                         reply_markup=InlineKeyboardMarkup(keyboard))
+    sent = send_photo(photo=photo)
+    if photo == product_info['photo_link']:
+        sent.add_done_callback(partial(remember_photo, photo_cache, product_id, product_info['photo_id']))
+    else:
+        sent.add_done_callback(partial(resend_photo, send_photo, photo_cache, product_id, product_info))
     update.effective_message.delete()
     return State.HANDLE_DESCRIPTION
 
 
-def add_to_cart(bot, update, store_id, client_id, client_secret):
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
+def remember_photo(photo_cache, product_id, photo_id, sent):
+    if not sent.cancelled() and sent.exception() is None:
+        photo_cache.set(product_id, photo_id, sent.result().photo[-1].file_id)
+
+
+def resend_photo(send_photo, photo_cache, product_id, product_info, sent):
+    if sent.cancelled() or not isinstance(sent.exception(), BadRequest):
+        return
+    logger.warning('Cached photo of product %s was rejected, sending it from Elastic Path', product_id)
+    photo_cache.delete(product_id)
+    send_photo(photo=product_info['photo_link']).add_done_callback(
+        partial(remember_photo, photo_cache, product_id, product_info['photo_id']))
+
+
+@track_handler
+def add_to_cart(bot, update, cart_store, product_cache):
     cart_id = update.effective_user.id
     product_id = update.callback_query.data.split(' ')[1]
     quantity = int(update.callback_query.data.split(' ')[2])
-    add_product_to_cart(elastic_token, cart_id, store_id, product_id, quantity)
+    cart_store.add(cart_id, product_id, product_cache.get(product_id), quantity)
     update.callback_query.answer(text='The product has been added to cart', show_alert=False)
     return State.HANDLE_DESCRIPTION
 
 
-def handle_cart_info(bot, update, store_id, client_id, client_secret):
+@track_handler
+def handle_cart_info(bot, update, cart_store):
     cart_id = update.effective_user.id
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
     if update.callback_query:
         try:
             product = update.callback_query.data.split(' ')[1]
-            delete_product_from_cart(elastic_token, cart_id, store_id, product)
+            cart_store.remove(cart_id, product)
         except IndexError:
             pass
-    cart_info, total_price = get_cart_items(elastic_token, cart_id, store_id)
+    cart_info, total_price = cart_store.get_items(cart_id)
     products_in_cart_info = []
     keyboard = [[InlineKeyboardButton('Menu', callback_data='menu'),
                  InlineKeyboardButton('Remove all', callback_data='remove_all')],
@@ -118,12 +246,10 @@ def handle_cart_info(bot, update, store_id, client_id, client_secret):
     return State.HANDLE_CART
 
 
-def handle_remove_all_from_cart(bot, update, store_id, client_id, client_secret):
+@track_handler
+def handle_remove_all_from_cart(bot, update, cart_store):
     cart_id = update.effective_user.id
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
-    remove_all_from_cart(elastic_token, cart_id, store_id)
+    cart_store.remove_all(cart_id)
     keyboard = [[InlineKeyboardButton('Menu', callback_data='menu')]]
     update.callback_query.answer(text='The product has been added to cart', show_alert=False)
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -135,6 +261,7 @@ def handle_remove_all_from_cart(bot, update, store_id, client_id, client_secret)
     return State.HANDLE_CART
 
 
+@track_handler
 def checkout(bot, update):
     user_first_name = update.effective_user.first_name
     keyboard = [[InlineKeyboardButton(text="Back to cart", callback_data="cart_info")]]
@@ -145,106 +272,153 @@ def checkout(bot, update):
     return State.WAITING_EMAIL
 
 
-def get_email(bot, update, store_id, client_id, client_secret):
+@track_handler
+def get_email(bot, update, checkout_pipeline):
     user_name = update.effective_message.from_user.first_name
-    user_email = update.effective_message.text
+    user_email = update.effective_message.text.strip()
     user_password = update.effective_message.from_user.id
-    if check_elastic_token():
-        update_elastic_token(client_id, client_secret, store_id)
-    elastic_token = os.getenv('ELASTIC_TOKEN')
-    customer = create_customer(user_name, user_email, user_password, store_id, elastic_token)
-    if customer:
-        keyboard = [[InlineKeyboardButton(text="Back to menu", callback_data="menu")]]
-        update.message.reply_text(text=f'Your email {user_email}. We contact you shortly',
-                                  reply_markup=InlineKeyboardMarkup(keyboard))
-    else:
+    if not is_valid_email(user_email):
         update.message.reply_text(text='Your email is not valid. Try again')
+        return State.WAITING_EMAIL
+    checkout_pipeline.submit(update.effective_message.chat_id, user_name, user_email, user_password)
+    keyboard = [[InlineKeyboardButton(text="Back to menu", callback_data="menu")]]
+    update.message.reply_text(text=f'Your email {user_email}. We contact you shortly',
+                              reply_markup=InlineKeyboardMarkup(keyboard))
     return State.WAITING_EMAIL
 
 
+def skip_duplicates(bot, update, deduplicator):
+    callback_query = update.callback_query
+    user_id = update.effective_user.id if update.effective_user else None
+    if deduplicator.is_duplicate(update.update_id, user_id, callback_query.data if callback_query else None):
+        if callback_query:
+            callback_query.answer()
+        raise DispatcherHandlerStop()
+
+
+def build_conversation_handler(checkout_pipeline, menu_cache, product_cache, photo_cache, cart_store,
+                               page_size=10):
+    menu = partial(handle_menu, menu_cache=menu_cache, page_size=page_size)
+    search = partial(handle_search, menu_cache=menu_cache, page_size=page_size)
+    description = partial(handle_description, product_cache=product_cache, photo_cache=photo_cache)
+    cart = partial(add_to_cart, cart_store=cart_store, product_cache=product_cache)
+    cart_info = partial(handle_cart_info, cart_store=cart_store)
+    remove_all = partial(handle_remove_all_from_cart, cart_store=cart_store)
+    email = partial(get_email, checkout_pipeline=checkout_pipeline)
+    return ThreadSafeConversationHandler(
+        entry_points=[CommandHandler('start', menu)],
+        states={State.HANDLE_MENU: [CallbackQueryHandler(menu, pattern='remove_all'),
+                                    CallbackQueryHandler(menu)],
+                State.HANDLE_DESCRIPTION: [CallbackQueryHandler(cart, pattern='^add_to_cart'),
+                                           CallbackQueryHandler(cart_info, pattern='cart_info'),
+                                           CallbackQueryHandler(menu, pattern='back'),
+                                           CallbackQueryHandler(menu, pattern='^menu_page'),
+                                           MessageHandler(Filters.text, search),
+                                           CallbackQueryHandler(description)],
+                State.HANDLE_CART: [CallbackQueryHandler(menu, pattern='menu'),
+                                    CallbackQueryHandler(remove_all, pattern='remove_all'),
+                                    CallbackQueryHandler(cart_info, pattern='^remove_item'),
+                                    CallbackQueryHandler(checkout, pattern='checkout')],
+                State.WAITING_EMAIL: [MessageHandler(Filters.text, email),
+                                      CallbackQueryHandler(cart_info, pattern='cart_info'),
+                                      CallbackQueryHandler(menu)]},
+        fallbacks=[CommandHandler('start', menu)])
+
+
+def run_webhook(bot, dispatcher, tg_token):
+    pool = UpdateWorkerPool(lambda raw_update: dispatcher.process_update(Update.de_json(raw_update, bot)),
+                            workers=int(os.getenv('WEBHOOK_WORKERS', 4)),
+                            queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', 100)))
+    url_path = f'/{os.getenv("WEBHOOK_PATH", tg_token)}'
+    server = WebhookServer((os.getenv('WEBHOOK_LISTEN', '0.0.0.0'), int(os.getenv('WEBHOOK_PORT', 8443))),
+                           pool, url_path=url_path)
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        bot.set_webhook(url=f'{webhook_url.rstrip("/")}{url_path}')
+    pool.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+
+
 def main():
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        level=logging.DEBUG)
     load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=os.getenv('LOG_LEVEL', 'INFO'))
+    start_instrumentation(metrics_port=os.getenv('METRICS_PORT'),
+                          metrics_listen=os.getenv('METRICS_LISTEN', '127.0.0.1'),
+                          profile_interval=os.getenv('PROFILE_INTERVAL'))
     tg_token = os.getenv("TG_TOKEN")
     client_id = os.getenv('CLIENT_ID')
     client_secret = os.getenv('CLIENT_SECRET')
     store_id = os.getenv('STORE_ID')
+    pool_size = int(os.getenv('ELASTIC_POOL_SIZE', 10))
+    catalog_ttl = int(os.getenv('CATALOG_TTL', 600))
+    elastic_client = ElasticPathClient(store_id, client_id, client_secret, pool_size=pool_size,
+                                       rate_limit=float(os.getenv('ELASTIC_RATE_LIMIT', 25)))
+    photo_cache = PhotoCache(os.getenv('PHOTO_CACHE_PATH', 'photo_cache.sqlite3'))
+    product_cache = ProductCache(partial(load_product_card,
+                                         elastic_client=elastic_client,
+                                         photo_cache=photo_cache),
+                                 maxsize=int(os.getenv('PRODUCT_CACHE_SIZE', 256)),
+                                 ttl=catalog_ttl)
+    menu_cache = CatalogCache(partial(prefetch_catalog, elastic_client, product_cache, photo_cache,
+                                      page_size=int(os.getenv('CATALOG_PAGE_SIZE', 100))),
+                              ttl=catalog_ttl,
+                              name='menu',
+                              refresh_interval=float(os.getenv('PREFETCH_INTERVAL', catalog_ttl / 2)))
+    menu_cache.start()
+    cart_store = CartStore(elastic_client,
+                           flush_delay=float(os.getenv('CART_FLUSH_DELAY', 0.5)),
+                           maxsize=int(os.getenv('CART_CACHE_SIZE', 10000)),
+                           ttl=float(os.getenv('CART_TTL', 300)))
+    cart_store.start()
 
-    updater = Updater(tg_token)
+    senders = int(os.getenv('TG_SENDERS', 4))
+    con_pool_size = max(int(os.getenv('WEBHOOK_WORKERS', 4)), 4) + senders + 5
+    bot = RateLimitedBot(tg_token, create_telegram_limiter(), senders=senders,
+                         request=Request(con_pool_size=con_pool_size))
+    bot.start()
+    updater = Updater(bot=bot)
     dp = updater.dispatcher
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', partial(handle_menu,
-                                                      store_id=store_id,
-                                                      client_id=client_id,
-                                                      client_secret=client_secret))],
-        states={State.HANDLE_MENU: [CallbackQueryHandler(partial(handle_menu,
-                                                                 store_id=store_id,
-                                                                 client_id=client_id,
-                                                                 client_secret=client_secret
-                                                                 ),
-                                                         pattern='remove_all'),
-                                    CallbackQueryHandler(partial(handle_menu,
-                                                                 store_id=store_id,
-                                                                 client_id=client_id,
-                                                                 client_secret=client_secret
-                                                                 ))],
-                State.HANDLE_DESCRIPTION: [CallbackQueryHandler(partial(add_to_cart,
-                                                                        store_id=store_id,
-                                                                        client_id=client_id,
-                                                                        client_secret=client_secret),
-                                                                pattern='^add_to_cart'),
-                                           CallbackQueryHandler(partial(handle_cart_info,
-                                                                        store_id=store_id,
-                                                                        client_id=client_id,
-                                                                        client_secret=client_secret),
-                                                                pattern='cart_info'),
-                                           CallbackQueryHandler(partial(handle_menu,
-                                                                        store_id=store_id,
-                                                                        client_id=client_id,
-                                                                        client_secret=client_secret),
-                                                                pattern='back'),
-                                           CallbackQueryHandler(partial(handle_description,
-                                                                        store_id=store_id,
-                                                                        client_id=client_id,
-                                                                        client_secret=client_secret))],
-                State.HANDLE_CART: [CallbackQueryHandler(partial(handle_menu,
-                                                                 store_id=store_id,
-                                                                 client_id=client_id,
-                                                                 client_secret=client_secret),
-                                                         pattern='menu'),
-                                    CallbackQueryHandler(partial(handle_remove_all_from_cart,
-                                                                 store_id=store_id,
-                                                                 client_id=client_id,
-                                                                 client_secret=client_secret),
-                                                         pattern='remove_all'),
-                                    CallbackQueryHandler(partial(handle_cart_info,
-                                                                 store_id=store_id,
-                                                                 client_id=client_id,
-                                                                 client_secret=client_secret),
-                                                         pattern='^remove_item'),
-                                    CallbackQueryHandler(checkout, pattern='checkout')
-                                    ],
-                State.WAITING_EMAIL: [MessageHandler(Filters.text, partial(get_email,
-                                                                           store_id=store_id,
-                                                                           client_id=client_id,
-                                                                           client_secret=client_secret)),
-                                      CallbackQueryHandler(partial(handle_cart_info,
-                                                                   store_id=store_id,
-                                                                   client_id=client_id,
-                                                                   client_secret=client_secret),
-                                                           pattern='cart_info'),
-                                      CallbackQueryHandler(partial(handle_menu,
-                                                                   store_id=store_id,
-                                                                   client_id=client_id,
-                                                                   client_secret=client_secret))]},
-        fallbacks=[CommandHandler('start', partial(handle_menu,
-                                                   store_id=store_id,
-                                                   client_id=client_id,
-                                                   client_secret=client_secret))])
+    state_backend = create_backend(os.getenv('STATE_BACKEND', 'sqlite'),
+                                   path=os.getenv('STATE_PATH', 'bot_state.sqlite3'),
+                                   redis_url=os.getenv('REDIS_URL'))
+    customers = PersistentDict(state_backend, 'customers')
+    customers.start()
+    checkout_pipeline = CheckoutPipeline(elastic_client,
+                                         notify=lambda chat_id, text: bot.send_message(chat_id, text),
+                                         customers=customers,
+                                         batch_size=int(os.getenv('CHECKOUT_BATCH_SIZE', 20)))
+    checkout_pipeline.start()
+    conv_handler = build_conversation_handler(checkout_pipeline, menu_cache, product_cache, photo_cache, cart_store,
+                                              page_size=int(os.getenv('MENU_PAGE_SIZE', 10)))
+    conversations = PersistentDict(state_backend, 'conversations',
+                                   encode=lambda state: state.name,
+                                   decode=lambda name: State[name])
+    conversations.start()
+    conv_handler.conversations = conversations
+    deduplicator = UpdateDeduplicator(callback_window=float(os.getenv('DEDUP_WINDOW', 1.0)))
+    dp.add_handler(TypeHandler(Update, partial(skip_duplicates, deduplicator=deduplicator)), group=-1)
     dp.add_handler(conv_handler)
-    updater.start_polling()
-    updater.idle()
+    if os.getenv('TG_MODE', 'polling') == 'webhook':
+        run_webhook(updater.bot, dp, tg_token)
+    else:
+        updater.start_polling()
+        updater.idle()
+    menu_cache.stop()
+    checkout_pipeline.stop()
+    bot.stop()
+    cart_store.stop()
+    customers.stop()
+    conversations.stop()
+    state_backend.close()
+    elastic_client.close()
+    photo_cache.close()
 
 
 if __name__ == '__main__':
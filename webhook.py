@@ -0,0 +1,115 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadSafeConversationHandler(ConversationHandler):
+    _local = threading.local()
+
+    @property
+    def current_conversation(self):
+        return getattr(self._local, 'current_conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, value):
+        self._local.current_conversation = value
+
+    @property
+    def current_handler(self):
+        return getattr(self._local, 'current_handler', None)
+
+    @current_handler.setter
+    def current_handler(self, value):
+        self._local.current_handler = value
+
+
+def get_chat_id(raw_update):
+    for key in ('message', 'edited_message', 'channel_post', 'callback_query'):
+        payload = raw_update.get(key)
+        if not payload:
+            continue
+        if key == 'callback_query':
+            payload = payload.get('message') or {'chat': payload.get('from', {})}
+        return payload.get('chat', {}).get('id')
+    return raw_update.get('update_id')
+
+
+class UpdateWorkerPool:
+    def __init__(self, process_update, workers=4, queue_size=100):
+        self.process_update = process_update
+        self.queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self._work, args=(queue,), daemon=True,
+                                         name=f'webhook-worker-{number}')
+                        for number, queue in enumerate(self.queues)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, raw_update, timeout=None):
+        queue = self.queues[hash(get_chat_id(raw_update)) % len(self.queues)]
+        queue.put(raw_update, timeout=timeout)
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, queue):
+        while True:
+            raw_update = queue.get()
+            try:
+                if raw_update is None:
+                    return
+                self.process_update(raw_update)
+            except Exception:
+                logger.exception('Update %s failed', raw_update.get('update_id'))
+            finally:
+                queue.task_done()
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            raw_update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            self.server.pool.submit(raw_update, timeout=self.server.enqueue_timeout)
+        except Full:
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, pool, url_path='/', enqueue_timeout=1):
+        super().__init__(address, WebhookRequestHandler)
+        self.pool = pool
+        self.url_path = url_path
+        self.enqueue_timeout = enqueue_timeout